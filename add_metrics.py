@@ -1,67 +1,119 @@
 import argparse
-import os
+import configparser
 import json
-from numpy import arange, ndarray, where, mean, array, argmax, argmin, var, sqrt, divide, logical_and
-from numpy.random import binomial
+import os
+import sys
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from spike_store import SessionData, select_neuroids
+from utilities import cumulative_spike_counts, atomic_open, share_arrays, attach_arrays
+from functools import lru_cache
+from numpy import arange, cumsum, mean, array, argmax, argmin, var, sqrt, divide, logical_and, errstate, \
+    take_along_axis, where, isnan, nan, unique, searchsorted, array_split, concatenate, stack, full, maximum, \
+    load, savez
+from numpy.random import default_rng
 import xarray as xr
 from sklearn.model_selection import ShuffleSplit
-from scipy.stats import spearmanr, ttest_1samp
+from scipy.stats import rankdata, ttest_1samp
 
+# Registered metrics, by name. Each entry holds the metric function, the names of its inputs, and whether it is
+# computed by default.
+METRICS = {}
 
-def _splithalf_r(data, num_simulation):
-    r_values = []
+
+def register_metric(name, inputs=('psth',), default=True):
+    """Decorator registering a per-channel metric under `name`.
+
+    The metric is called with one array per name in `inputs`, possibly restricted to a subset of channels (the last
+    axis), and returns whether each of these channels passed. Inputs are (trial, stimulus, channel) responses:
+    'psth' for the main stimuli, 'grey_psth' for the grey images, 'baseline_psth' for all baseline stimuli; and
+    their (count, sum, sum of squares) over trials, (3, stimulus, channel): 'psth_stats', 'grey_psth_stats' and
+    'baseline_psth_stats'. Metrics that are not `default` are only computed when asked for by name.
+    """
+    def decorator(function):
+        METRICS[name] = {'function': function, 'inputs': tuple(inputs), 'default': default}
+        return function
+    return decorator
+
+
+@lru_cache(maxsize=None)
+def _split_indices(n_trials, num_simulation):
+    """Train and test trial indices, (split, n_trials // 2) each, of randomly shuffled split halves.
+
+    Splits only depend on the number of trials, so they are computed once and shared by all channels.
+    """
     # Split randomly shuffled data into two equal sized sets over 'trial' dimension.
     random_state = 12883823
     ss = ShuffleSplit(n_splits=num_simulation, test_size=0.5, random_state=random_state)
-    # Compute Spearman-Brown corrected correlation between the two sets.
-    for train_index, text_index in ss.split(data):
-        train = array([data[_] for _ in train_index])
-        test = array([data[_] for _ in text_index])
-        # Compute Spearman correlation.
-        r = spearmanr(train.mean(axis=0), test.mean(axis=0)).correlation
-        # Apply Spearman-Brown correction.
+    train_index, test_index = zip(*ss.split(arange(n_trials)))
+    return array(train_index), array(test_index)
+
+
+def _splithalf_r(data, num_simulation):
+    """Spearman-Brown corrected split-half correlation of image rank-order, for all channels at once.
+
+    `data` is a (trial, stimulus, channel) array; returns one value per channel.
+    """
+    train_index, test_index = _split_indices(data.shape[0], num_simulation)
+    # Average each half over trials, for all splits at once: (split, stimulus, channel).
+    train = data[train_index].mean(axis=1)
+    test = data[test_index].mean(axis=1)
+    # Compute Spearman correlation, i.e. the Pearson correlation of ranks over stimuli.
+    train = rankdata(train, axis=1)
+    test = rankdata(test, axis=1)
+    train = train - train.mean(axis=1, keepdims=True)
+    test = test - test.mean(axis=1, keepdims=True)
+    with errstate(divide='ignore', invalid='ignore'):
+        r = (train * test).sum(axis=1) / sqrt((train ** 2).sum(axis=1) * (test ** 2).sum(axis=1))
+        # Apply Spearman-Brown correction (r is -1 or undefined for some resampled data).
         r_corrected = 2 * r / (1 + r)
-        r_values.append(r_corrected)
-    return mean(r_values)
+    return mean(r_corrected, axis=0)
 
 
-def iro_reliability(psth_xr):
+@register_metric('reliability', inputs=['psth'])
+def _reliability_metric(psth):
     num_simulation = 50
-    reliability_per_channel = []
-    for ch_name, ch_xr in psth_xr.groupby('channel'):
-        # Compute Spearman-Brown corrected split-half correlation of image rank-order averaged over
-        # 'num_simulation' runs.
-        reliability_per_channel.append(_splithalf_r(ch_xr.data.T, num_simulation))
-    return array(reliability_per_channel) > 0.6
+    # Compute Spearman-Brown corrected split-half correlation of image rank-order averaged over
+    # 'num_simulation' runs.
+    return _splithalf_r(psth, num_simulation) > 0.6
 
 
-def _selectivity(data, num_simulation):
-    s_values = []
-    # Split randomly shuffled data into two equal sized sets over 'trial' dimension.
-    random_state = 12883823
-    ss = ShuffleSplit(n_splits=num_simulation, test_size=0.5, random_state=random_state)
-    for train_index, text_index in ss.split(data):
-        train = array([data[_] for _ in train_index])
-        test = array([data[_] for _ in text_index])
+def iro_reliability(psth_xr):
+    return _reliability_metric(_responses(psth_xr))
 
-        # Compute indexes of 'best' and 'worst' stimulus (based on mean spike count rate
-        # cross trials) on train set.
-        best_idx = argmax(mean(train, axis=0))
-        worst_idx = argmin(mean(train, axis=0))
 
-        # Test on test set.
-        means = mean(test, axis=0)
-        variances = var(test, axis=0)
-        s_values.append((means[best_idx] - means[worst_idx]) / sqrt(0.5 * (variances[best_idx] + variances[worst_idx])))
-    return mean(s_values)
+def _selectivity(data, num_simulation):
+    """Selectivity (d-prime between the 'best' and 'worst' stimulus) for all channels at once.
+
+    `data` is a (trial, stimulus, channel) array; returns one value per channel.
+    """
+    # Use the same split halves as the reliability metric.
+    train_index, test_index = _split_indices(data.shape[0], num_simulation)
+
+    # Compute indexes of 'best' and 'worst' stimulus (based on mean spike count rate
+    # cross trials) on train set, for every (split, channel).
+    train_means = data[train_index].mean(axis=1)
+    best_idx = argmax(train_means, axis=1)[:, None, :]
+    worst_idx = argmin(train_means, axis=1)[:, None, :]
+
+    # Test on test set.
+    test = data[test_index]
+    means = mean(test, axis=1)
+    variances = var(test, axis=1)
+    with errstate(divide='ignore', invalid='ignore'):
+        s_values = (take_along_axis(means, best_idx, axis=1) - take_along_axis(means, worst_idx, axis=1)) / \
+            sqrt(0.5 * (take_along_axis(variances, best_idx, axis=1) + take_along_axis(variances, worst_idx, axis=1)))
+    return mean(s_values[:, 0, :], axis=0)
+
+
+@register_metric('selectivity', inputs=['psth'])
+def _selectivity_metric(psth):
+    num_simulation = 50
+    return _selectivity(psth, num_simulation) > 1
 
 
 def selectivity(psth_xr):
-    num_simulation = 50
-    selectivity_per_channel = []
-    for ch_name, ch_xr in psth_xr.groupby('channel'):
-        selectivity_per_channel.append(_selectivity(ch_xr.data.T, num_simulation))
-    return array(selectivity_per_channel) > 1
+    return _selectivity_metric(_responses(psth_xr))
 
 
 # def _visual_drive(data, grey_data):
@@ -72,61 +124,347 @@ def selectivity(psth_xr):
 #     var_stim = mean(var(data, axis=0))
 #     var_grey = mean(var(data, axis=0))
 #     return (mean_response_stim - mean_response_grey) / sqrt(0.5 * (var_stim + var_grey))
-#
-#
-# def _flip():
-#     """Returns 1 or -1 with equal probability."""
-#     return 1 if binomial(1, 0.5) == 1 else -1
-#
-#
-# def perm_test(x, stat='mean'):
-#     """Performs a one-sample permutation test.
-#
-#     Permutations are produced by multiplying observations by +1 or -1, so
-#     the total number of permutations possible is 2^n for a sample of size n.
-#     """
-#     assert stat is 'mean'
-#     num_permutations = 10
-#     # If number of permutations exceeds 2^(n-1), then it will be ignored
-#     # since an exact test will be performed.
-#     if num_permutations >= 2 ** (len(x) - 1):
-#         num_permutations = 2 ** (len(x) - 1)
-#     # Calculate mean of observed data.
-#     mu = mean(x)
-#     # Calculate mean for all possible permutations of data, and subtract from this
-#     # the mean of the observed data.
-#     mu_differences = []
-#     for _ in range(num_permutations):
-#         permuted_x = [_flip() * _ for _ in x]
-#         mu_differences.append(mean(permuted_x) - mu)
-#     # Take mean of differences in mean of permuted and observed data, which will serve
-#     # as our approximation of the p-value.
-#     return mean(mu_differences)
-
-
-def _visual_drive(data, grey_data):
+
+
+# Memory (in bytes) that one call of a statistic in `null_distribution` may use, by default.
+NULL_MEMORY = 2 ** 29
+
+
+def null_distribution(statistic, data, kind, num_permutations, chunk_size=None, seed=12883823, expansion=1,
+                      memory=NULL_MEMORY):
+    """Values of `statistic` for `num_permutations` resampled copies of `data`, as a (channel, permutation) array.
+
+    `statistic` maps an array with channels along its last axis to one value per channel. `kind` 'sign' flips
+    the sign of random rows (axis 0); 'shuffle' shuffles the stimuli (axis 1) of every trial (axis 0). Each call
+    of `statistic`, using `expansion` times the memory of its input, is kept within `memory` bytes.
+    """
+    assert kind in ['sign', 'shuffle']
+    rng = default_rng(seed)
+    n_channels = data.shape[-1]
+    # Memory used by the statistic for one permutation of one channel (of float64 data).
+    cell = max(8 * data.size // max(n_channels, 1), 1) * expansion
+    chunk_size = chunk_size or max(1, min(num_permutations, memory // cell))
+    shard_size = max(1, memory // (cell * chunk_size))
+
+    values = []
+    for start in range(0, num_permutations, chunk_size):
+        n = min(chunk_size, num_permutations - start)
+        # Random numbers are drawn one permutation after another, so results do not depend on the chunk size.
+        if kind == 'sign':
+            signs = rng.choice([-1., 1.], size=(n, data.shape[0])).T
+            signs = signs.reshape((data.shape[0],) + (1,) * (data.ndim - 1) + (n,))
+        else:
+            # Random permutations of the stimuli, for every (trial, permutation): (trial, stimulus, permutation).
+            order = rng.random((n, data.shape[0], data.shape[1])).argsort(axis=2).transpose(1, 2, 0)
+
+        # All channels get the same permutations, so they can be resampled a shard at a time.
+        chunk = []
+        for first in range(0, max(n_channels, 1), shard_size):
+            shard = data[..., first:first + shard_size]
+            if kind == 'sign':
+                batch = shard[..., None] * signs
+            else:
+                batch = shard[arange(data.shape[0])[:, None, None], order].swapaxes(-1, -2)
+            chunk.append(statistic(batch.reshape(batch.shape[:-2] + (-1,))).reshape(shard.shape[-1], n))
+        values.append(concatenate(chunk, axis=0))
+    return concatenate(values, axis=1)
+
+
+def permutation_pvalues(statistic, data, kind, num_permutations, chunk_size=None, expansion=1):
+    """One-sided permutation test p-values of `statistic` (larger is more extreme) for every channel.
+
+    See `null_distribution` for the arguments.
+    """
+    observed = statistic(data)
+    null = null_distribution(statistic, data, kind, num_permutations, chunk_size, expansion=expansion)
+    # Channels whose statistic is undefined get no p-value either.
+    return where(isnan(observed), nan, (1 + (null >= observed[:, None]).sum(axis=1)) / (1 + num_permutations))
+
+
+def _response_stats(data):
+    """Sufficient statistics over trials of (trial, stimulus, channel) responses.
+
+    Returns (count, sum, sum of squares) stacked into a (3, stimulus, channel) array. Statistics of
+    different sets of trials (e.g. sessions) add up.
+    """
+    return stack([full(data.shape[1:], data.shape[0], dtype=float), data.sum(axis=0), (data ** 2).sum(axis=0)])
+
+
+def _moments(stats):
+    """Mean and variance over trials, from `_response_stats`."""
+    count, total, squares = stats
+    means = total / count
+    return means, maximum(squares / count - means ** 2, 0)
+
+
+def _dprime(stats, grey_stats):
+    """(stimulus, channel) d-prime of the responses to each stimulus against those to the grey image(s).
+
+    `stats` and `grey_stats` are (3, stimulus, channel) statistics of the responses (see `_response_stats`).
+    """
+    means, variances = _moments(stats)
+    grey_means, grey_variances = _moments(grey_stats)
+
     # We compute d-prime values. Note that for the main stimuli (data), we only take mean
     # across trials and not images. This is because we want to do a one-sample t-test later.
-    dprime_values = divide(mean(data, axis=0) - mean(mean(grey_data, axis=0)),
-                           sqrt(0.5 * (var(data, axis=0) + mean(var(grey_data, axis=0)))))
+    with errstate(divide='ignore', invalid='ignore'):
+        return divide(means - mean(grey_means, axis=0), sqrt(0.5 * (variances + mean(grey_variances, axis=0))))
+
+
+def _visual_drive(stats, grey_stats):
+    """Visual drive p-values for all channels at once; see `_dprime` for the arguments."""
+    dprime_values = _dprime(stats, grey_stats)
 
     # Do a t-test (null hypothesis is m = 0, that is the difference in means is not significant).
-    return ttest_1samp(dprime_values, 0).pvalue
+    return ttest_1samp(dprime_values, 0, axis=0).pvalue
+
+
+@register_metric('visual_drive', inputs=['psth_stats', 'grey_psth_stats'])
+def _visual_drive_metric(psth_stats, grey_psth_stats):
+    # Each channel is compared against its own responses to the grey image(s).
+    return _visual_drive(psth_stats, grey_psth_stats) < 0.05
 
 
 def visual_drive(psth_xr, grey_psth_xr):
-    drive_per_channel = []
-    for (ch_name, ch_xr), (_, grey_ch_xr) in zip(psth_xr.groupby('channel'), grey_psth_xr.groupby('channel')):
-        drive_per_channel.append(_visual_drive(ch_xr.data.T, grey_psth_xr.data.T))
-    return array(drive_per_channel) < 0.05
+    return _visual_drive_metric(_response_stats(_responses(psth_xr)), _response_stats(_responses(grey_psth_xr)))
+
+
+def _abs_mean(data):
+    with errstate(invalid='ignore'):
+        return abs(mean(data, axis=0))
+
+
+def _splithalf_r_statistic(data):
+    return _splithalf_r(data, 50)
+
+
+def _selectivity_statistic(data):
+    return _selectivity(data, 50)
+
+
+# Permutation test versions of the metrics (not computed by default). The null distribution of image rank-order
+# reliability and selectivity shuffles the stimuli of every trial; that of visual drive flips the sign of the
+# d-prime of every stimulus (two-sided, like the t-test).
+NUM_PERMUTATIONS = 1000
+
+
+def iro_reliability_pvalues(psth_xr, num_permutations=NUM_PERMUTATIONS):
+    return _reliability_pvalues(_responses(psth_xr), num_permutations)
+
+
+def selectivity_pvalues(psth_xr, num_permutations=NUM_PERMUTATIONS):
+    return _selectivity_pvalues(_responses(psth_xr), num_permutations)
 
 
-def main(data, path, filename):
-    bin_size = 10
-    start_time = 70
-    stop_time = 170
+def visual_drive_pvalues(psth_xr, grey_psth_xr, num_permutations=NUM_PERMUTATIONS):
+    return _visual_drive_pvalues(_response_stats(_responses(psth_xr)), _response_stats(_responses(grey_psth_xr)),
+                                 num_permutations)
 
-    timebins = arange(start_time, stop_time, bin_size)
+
+# Both split-half statistics hold the data of 50 train and 50 test halves at once (50 copies of their input).
+SPLITHALF_EXPANSION = 50 + 1
+
+
+def _reliability_pvalues(psth, num_permutations=NUM_PERMUTATIONS):
+    return permutation_pvalues(_splithalf_r_statistic, psth, 'shuffle', num_permutations,
+                               expansion=SPLITHALF_EXPANSION)
+
+
+def _selectivity_pvalues(psth, num_permutations=NUM_PERMUTATIONS):
+    return permutation_pvalues(_selectivity_statistic, psth, 'shuffle', num_permutations,
+                               expansion=SPLITHALF_EXPANSION)
+
+
+def _visual_drive_pvalues(psth_stats, grey_psth_stats, num_permutations=NUM_PERMUTATIONS):
+    return permutation_pvalues(_abs_mean, _dprime(psth_stats, grey_psth_stats), 'sign', num_permutations)
+
+
+@register_metric('reliability_permutation', inputs=['psth'], default=False)
+def _reliability_permutation_metric(psth):
+    return _reliability_pvalues(psth) < 0.05
+
+
+@register_metric('selectivity_permutation', inputs=['psth'], default=False)
+def _selectivity_permutation_metric(psth):
+    return _selectivity_pvalues(psth) < 0.05
+
+
+@register_metric('visual_drive_permutation', inputs=['psth_stats', 'grey_psth_stats'], default=False)
+def _visual_drive_permutation_metric(psth_stats, grey_psth_stats):
+    return _visual_drive_pvalues(psth_stats, grey_psth_stats) < 0.05
+
+
+def _responses(psth_xr):
+    """(trial, stimulus, channel) array of the responses in a PSTH DataArray."""
+    return psth_xr.transpose('trial', 'stimulus', 'channel').data
+
+
+def load_plugins(files):
+    """Import Python files defining user metrics (with `register_metric`), adding them to METRICS."""
+    # Plugins importing add_metrics have to register into this module, also when it is run as a script.
+    sys.modules.setdefault('add_metrics', sys.modules[__name__])
+    for file in files:
+        spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(file))[0], file)
+        spec.loader.exec_module(importlib.util.module_from_spec(spec))
+
+
+def _metric_task(name, shared, channels):
+    """Compute metric `name` for a (start, stop) range of channels in a worker process."""
+    metric = METRICS[name]
+    with attach_arrays(shared, metric['inputs']) as inputs:
+        return array(metric['function'](*[inputs[_][..., channels[0]:channels[1]] for _ in metric['inputs']]))
+
+
+def run_metrics(inputs, names=None, workers=1, n_shards=None, plugins=()):
+    """Compute registered metrics on (trial, stimulus, channel) `inputs`, keyed by input name.
+
+    Metrics and shards of channels are independent work units, spread over a pool of `workers` processes with
+    the inputs in shared memory. Returns a dict of per-channel results, keyed by metric name.
+    """
+    names = [_ for _ in METRICS if METRICS[_]['default']] if names is None else list(names)
+    for name in names:
+        assert name in METRICS, 'Unknown metric: ' + name
+        assert all(_ in inputs for _ in METRICS[name]['inputs']), 'Missing inputs for metric: ' + name
+    if workers <= 1:
+        return {name: array(METRICS[name]['function'](*[inputs[_] for _ in METRICS[name]['inputs']]))
+                for name in names}
+
+    n_channels = next(iter(inputs.values())).shape[-1]
+    bounds = [(_[0], _[-1] + 1) for _ in array_split(arange(n_channels), n_shards or workers) if len(_)]
+    shms, shared = share_arrays(inputs)
+    try:
+        # Plugins are loaded again in the workers, in case they are not forked from this process.
+        with ProcessPoolExecutor(max_workers=workers, initializer=load_plugins, initargs=(plugins,)) as executor:
+            futures = {name: [executor.submit(_metric_task, name, shared, _) for _ in bounds] for name in names}
+            return {name: concatenate([_.result() for _ in futures[name]]) for name in names}
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+
+def timebins(start_time, stop_time, bin_size, step=None):
+    """Start times of the bins of `bin_size` ms, one every `step` ms (`bin_size` by default), that fit in the
+    window [start_time, stop_time]. Bins overlap if `step` is smaller than `bin_size`.
+    """
+    step = step or bin_size
+    n_bins = int((stop_time - start_time - bin_size) / step + 1e-9) + 1
+    assert n_bins > 0, 'Window %g-%g ms is shorter than a bin' % (start_time, stop_time)
+    return start_time + step * arange(n_bins)
+
+
+def _cumulative_counts(table, ch_names, edges):
+    """(stimulus, trial, edge, channel) counts of spikes below, and up to, each of the `edges` (in ms).
+
+    Returns (edges, lt, le); see `cumulative_spike_counts`.
+    """
+    # Put channels in the order they are listed in.
+    table = select_neuroids(table, ch_names)
+
+    lt, le = cumulative_spike_counts(table['times'] * 1000, table['offsets'], edges)  # in ms
+    shape = (len(ch_names), len(table['item']), len(table['trial']), len(edges))
+    return edges, lt.reshape(shape).transpose(1, 2, 3, 0), le.reshape(shape).transpose(1, 2, 3, 0)
+
+
+def _psth(table, ch_names, timebins, bin_size, counts=None):
+    """Build a (stimulus, trial, timebin, channel) PSTH from a packed spike table.
+
+    Spikes of all (channel, stimulus, trial) cells are counted in a single pass, cumulatively at the bin edges,
+    so the count of every bin is a subtraction. The `_cumulative_counts` of the table can be passed in to build
+    PSTHs for several windows from one pass; their edges have to include those of all bins.
+    """
+    edges, lt, le = counts or _cumulative_counts(table, ch_names, unique(concatenate([timebins, timebins + bin_size])))
+    psth = le[:, :, searchsorted(edges, timebins + bin_size)] - lt[:, :, searchsorted(edges, timebins)]
+
+    time_labels = ['%g-%g' % (_, _ + bin_size) for _ in timebins]
+    return xr.DataArray(psth.astype(float), coords=[table['item'].tolist(), table['trial'].tolist(), time_labels,
+                                                    ch_names],
+                        dims=['stimulus', 'trial', 'timebin', 'channel'])
+
+
+def _session_responses(handle, session, trials, baseline_trials, ch_names, windows, bin_size, step, cache_dir=None):
+    """Responses of one session (trials and baseline trials at the given positions) and their statistics.
+
+    Returns one dict of responses, averaged over the timebins, per (start_time, stop_time) window. Results are
+    cached in `cache_dir` by the digest of the session's spikes; only if they are not, the spikes of the session
+    are read from the `SessionData` handle, and counted once for all windows.
+    """
+    responses, cache_files = [None] * len(windows), [None] * len(windows)
+    for i, (start_time, stop_time) in enumerate(windows):
+        if cache_dir is None:
+            continue
+        cache_files[i] = os.path.join(cache_dir, '%s_%g-%g_%g_%g.npz' % (session['hash'], start_time, stop_time,
+                                                                         bin_size, step or bin_size))
+        if os.path.isfile(cache_files[i]):
+            with load(cache_files[i]) as cached:
+                index = {neuroid: j for j, neuroid in enumerate(cached['neuroid'].tolist())}
+                if all(_ in index for _ in ch_names) and len(cached['psth']) == len(trials) and \
+                        len(cached['baseline_psth']) == len(baseline_trials):
+                    columns = [index[_] for _ in ch_names]
+                    responses[i] = {key: cached[key][..., columns] for key in cached.files if key != 'neuroid'}
+
+    missing = [i for i, _ in enumerate(responses) if _ is None]
+    if not missing:
+        return responses
+
+    # Count spikes at the edges of the bins of all missing windows in one pass.
+    bins = [timebins(windows[i][0], windows[i][1], bin_size, step) for i in missing]
+    edges = unique(concatenate([concatenate([_, _ + bin_size]) for _ in bins]))
+    for name, table, positions in [('psth', 'spikes', trials), ('baseline_psth', 'baseline/spikes', baseline_trials)]:
+        table = handle.table(table, trials=(positions[0], positions[-1] + 1))
+        counts = _cumulative_counts(table, ch_names, edges)
+        for i, window_bins in zip(missing, bins):
+            responses[i] = responses[i] or {}
+            responses[i][name] = _responses(_psth(table, ch_names, window_bins, bin_size, counts).mean('timebin'))
+            responses[i][name + '_stats'] = _response_stats(responses[i][name])
+
+    for i in missing:
+        if cache_files[i] is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with atomic_open(cache_files[i]) as f:
+                savez(f, neuroid=array(ch_names, dtype=str), **responses[i])
+    return responses
+
+
+def write_metrics(file, data_file, ch_names, results, bin_size, step):
+    """Add metric results to the metrics (sidecar) file of a data file.
+
+    `results` holds the per-channel results of every metric, for each (start_time, stop_time) PSTH window. The
+    metrics file holds a column of 0/1 values (one per neuroid) for every metric, and for whether a neuroid passed
+    all of them, per window and binning. Results for other windows (or binnings) already in the file are kept.
+    `passed_metrics` holds those of the first window in `results`.
+    """
+    metrics = {}
+    if os.path.isfile(file):
+        with open(file) as f:
+            metrics = json.load(f)
+    # Results computed for other neuroids are out of date.
+    if metrics.get('neuroid_id') != list(ch_names):
+        metrics = {'neuroid_id': list(ch_names), 'windows': {}}
+    metrics['data_file'] = os.path.basename(data_file)
+
+    for i, (window, window_results) in enumerate(results.items()):
+        passed = logical_and.reduce([window_results[_] for _ in window_results])
+        assert len(ch_names) == len(passed)
+        # Results are only comparable for the same binning, so bin size and step are part of the key.
+        metrics['windows']['%g-%g_%g_%g' % (tuple(window) + (bin_size, step or bin_size))] = {
+            'bin_size': bin_size, 'step': step or bin_size,
+            'metrics': {name: [int(_) for _ in value] for name, value in window_results.items()},
+            'passed': [int(_) for _ in passed]}
+        if i == 0:
+            metrics['passed_metrics'] = {neuroid: int(value) for neuroid, value in zip(ch_names, passed)}
+
+    with atomic_open(file) as f:
+        f.write(json.dumps(metrics, indent=4).encode())
+
+
+# Default PSTH window (start_time, stop_time) and bin size, in ms after stimulus onset.
+WINDOW = (70, 170)
+BIN_SIZE = 10
+
+
+def main(handle, path, filename, data_file, metrics=None, workers=1, plugins=(), cache=True, windows=(WINDOW,),
+         bin_size=BIN_SIZE, step=None):
 
     # peristim = ndarray(shape=(data['n_channels'], len(data['item']['id']), len(timebins)), dtype=float, order='F')
     # for i, channel in enumerate(data['spikes']):
@@ -147,95 +485,105 @@ def main(data, path, filename):
     # peristim_xr = xr.DataArray(peristim, coords=[neuroid_ids, items, timebins], dims=['neuroid', 'item', 'bin'])
     # print(peristim_xr.sel(neuroid='A-000', item='1'))
 
-    psth = ndarray(shape=(len(data['item']['id']), data['n_trials'], len(timebins), data['n_channels']),
-                   dtype=float, order='F')
-
-    for i, channel in enumerate(data['spikes']):
-        for ii, stimulus in enumerate(data['spikes'][channel]):
-            for iii, spiketrain in enumerate(data['spikes'][channel][stimulus].values()):
-                spiketrain = [_ * 1000 for _ in spiketrain]
-                counts = []
-                for _ in timebins:
-                    counts.append(where((spiketrain >= _) & (spiketrain <= (_ + bin_size)))[0].size)
-                psth[ii, iii, :, i] = counts
-
-    stimulus_labels = [str(_) for _ in list(data['item']['id'].values())]
-    trial_labels = [str(_) for _ in list(range(1, data['n_trials'] + 1))]
-    time_labels = [str(_) + '-' + str(_ + bin_size) for _ in timebins]
+    # Only metadata is parsed up front; spikes are read session by session, if they are not cached.
+    data = handle.metadata
     ch_names = list(data['neuroid']['neuroid_id'].values())
-    psth_xr = xr.DataArray(psth, coords=[stimulus_labels, trial_labels, time_labels, ch_names],
-                           dims=['stimulus', 'trial', 'timebin', 'channel'])
-
-    print('Shape is', psth_xr.shape)
-
-    # We take average of response across the 'timebin' dimension (70-170ms).
-    psth_xr = psth_xr.mean('timebin')
-
-    print('Shape is', psth_xr.shape)
-
-    # For computing the visual drive, we require neural responses to grey image.
-    # We thus first construct a psth for the baseline stimuli.
-    baseline_psth = ndarray(shape=(data['baseline']['n_grey']+data['baseline']['n_other'],
-                                      data['n_trials'], len(timebins), data['n_channels']),
-                               dtype=float, order='F')
-
-    for i, channel in enumerate(data['baseline']['spikes']):
-        for ii, stimulus in enumerate(data['baseline']['spikes'][channel]):
-            for iii, spiketrain in enumerate(data['baseline']['spikes'][channel][stimulus].values()):
-                spiketrain = [_ * 1000 for _ in spiketrain]
-                counts = []
-                for _ in timebins:
-                    counts.append(where((spiketrain >= _) & (spiketrain <= (_ + bin_size)))[0].size)
-                baseline_psth[ii, iii, :, i] = counts
-
-    baseline_labels = [str(_) for _ in list(data['baseline']['spikes'][ch_names[0]].keys())]
-    # baseline_labels = [str(_) for _ in list(range(data['baseline']['n_grey']+data['baseline']['n_other']))]
-    baseline_psth_xr = xr.DataArray(baseline_psth, coords=[baseline_labels, trial_labels, time_labels, ch_names],
-                                    dims=['stimulus', 'trial', 'timebin', 'channel'])
-
-    print('Baseline shape is', baseline_psth_xr.shape)
-
-    # We take average of response across the 'timebin' dimension 70-170ms.
-    baseline_psth_xr = baseline_psth_xr.mean('timebin')
-
-    print('Baseline shape is', baseline_psth_xr.shape)
-
-    # Compute the metrics.
-    reliability_per_channel = iro_reliability(psth_xr)
-    selectivity_per_channel = selectivity(psth_xr)
-    drive_per_channel = visual_drive(psth_xr, baseline_psth_xr.isel(stimulus=list(range(data['baseline']['n_grey']))))
-
-    values_per_channel = logical_and(logical_and(reliability_per_channel, selectivity_per_channel), drive_per_channel)
-    assert len(ch_names) == len(values_per_channel)
-    passed_metrics = {}
-    for _, value in zip(ch_names, values_per_channel):
-        passed_metrics[_] = int(value)
-
-    # Add metrics values to the original data file and save (locally for now).
-    data['passed_metrics'] = passed_metrics
-    with open('data.json', 'w') as f:
-        json.dump(data, f, indent=4)  # TODO: Decide on where to save the file.
+    assert handle.items() == [str(_) for _ in list(data['item']['id'].values())]
+    # For computing the visual drive, we require neural responses to grey image. We thus also
+    # construct a psth for the baseline stimuli.
+    assert len(handle.items('baseline/spikes')) == data['baseline']['n_grey'] + data['baseline']['n_other']
+
+    # Compute the responses session by session, averaged across the 'timebin' dimension of each window (70-170ms
+    # by default). Sessions that have been seen before are loaded from the cache, so only new sessions are binned.
+    sessions = handle.sessions()
+    assert sum(_['n_trials'] for _ in sessions) == len(handle.trials())
+    assert sum(_['n_baseline_trials'] for _ in sessions) == len(handle.trials('baseline/spikes'))
+    trials = cumsum([0] + [_['n_trials'] for _ in sessions])
+    baseline_trials = cumsum([0] + [_['n_baseline_trials'] for _ in sessions])
+    blocks = [_session_responses(handle, session, arange(trials[i], trials[i + 1]),
+                                 arange(baseline_trials[i], baseline_trials[i + 1]), ch_names, windows, bin_size,
+                                 step, os.path.join(path, 'metrics_cache') if cache else None)
+              for i, session in enumerate(sessions)]
+
+    results = {}
+    for i, window in enumerate(windows):
+        # Responses of all sessions are stacked along trials, and their statistics add up.
+        psth = concatenate([_[i]['psth'] for _ in blocks])
+        baseline_psth = concatenate([_[i]['baseline_psth'] for _ in blocks])
+        psth_stats = sum(_[i]['psth_stats'] for _ in blocks)
+        baseline_psth_stats = sum(_[i]['baseline_psth_stats'] for _ in blocks)
+
+        print('Window %g-%g ms' % tuple(window))
+        print('Shape is', psth.shape)
+        print('Baseline shape is', baseline_psth.shape)
+
+        # Compute the metrics. A channel passes if it passes all of them.
+        n_grey = data['baseline']['n_grey']
+        inputs = {'psth': psth, 'grey_psth': baseline_psth[:, :n_grey], 'baseline_psth': baseline_psth,
+                  'psth_stats': psth_stats, 'grey_psth_stats': baseline_psth_stats[:, :n_grey],
+                  'baseline_psth_stats': baseline_psth_stats}
+        results[tuple(window)] = run_metrics(inputs, metrics, workers=workers, plugins=plugins)
+
+    # Store metrics values in a file next to the data file, which is left as it is.
+    write_metrics(os.path.join(path, filename + '_metrics.json'), data_file, ch_names, results, bin_size, step)
 
     return
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Multi-unit activity analysis tools.')
-    parser.add_argument('--data', type=str, help='full path and name of the .json file '
+    parser.add_argument('--data', type=str, help='full path and name of the .npz (or .json) file '
                                                  'containing spike times and experiment metadata')
+    parser.add_argument('--metrics', type=str, nargs='+', help='names of the metrics a channel has to pass '
+                                                               '(default: reliability, selectivity, visual_drive and '
+                                                               'plugin metrics); permutation test versions are '
+                                                               'reliability_permutation, selectivity_permutation and '
+                                                               'visual_drive_permutation')
+    parser.add_argument('--plugins', type=str, nargs='+', default=[], help='Python files registering additional '
+                                                                           'metrics (with register_metric)')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes computing the metrics')
+    parser.add_argument('--config', type=str, help='full path and name of the .ini file defining the experiment '
+                                                   'parameters; the PSTH window and bin size are read from its '
+                                                   '[PSTH] section, if any')
+    parser.add_argument('--window', type=float, nargs=2, action='append', metavar=('START', 'STOP'),
+                        help='PSTH window in ms after stimulus onset (default: %g %g); repeat to evaluate several '
+                             'windows' % WINDOW)
+    parser.add_argument('--bin-size', type=float, help='PSTH bin size in ms (default: %g)' % BIN_SIZE)
+    parser.add_argument('--step', type=float, help='step between PSTH bins in ms (default: the bin size); bins '
+                                                   'overlap (sliding window) if it is smaller than the bin size')
+    parser.add_argument('--no-cache', action='store_true', help='recompute the responses of all sessions instead '
+                                                                'of using (and updating) the metrics_cache directory')
     args = parser.parse_args()
 
+    load_plugins(args.plugins)
+
+    # PSTH settings given on the command line take precedence over those in the config file.
+    windows, bin_size, step = [WINDOW], BIN_SIZE, None
+    if args.config is not None:
+        assert os.path.isfile(args.config)
+        config = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation(),
+                                           inline_comment_prefixes=('#', ';'))
+        config.read(args.config)
+        if config.has_section('PSTH'):
+            windows = [(config.getfloat('PSTH', 'start_time', fallback=WINDOW[0]),
+                        config.getfloat('PSTH', 'stop_time', fallback=WINDOW[1]))]
+            bin_size = config.getfloat('PSTH', 'bin_size', fallback=BIN_SIZE)
+            step = config.getfloat('PSTH', 'step', fallback=None)
+    windows = args.window or windows
+    bin_size = args.bin_size or bin_size
+    step = args.step or step
+
     assert args.data is not None
     assert os.path.isfile(args.data)
 
-    # Load data file.
-    with open(args.data) as f:
-        data = json.load(f)
+    # Open data file. Only metadata is parsed at this point.
+    handle = SessionData(args.data)
+    data = handle.metadata
 
     # Check if necessary fields are present.
     assert 'start_time' in data
     assert 'stop_time' in data
-    assert 'spikes' in data
+    assert 'spikes' in handle.tables
     assert 'n_channels' in data
     assert 'n_trials' in data
     assert 'neuroid' in data
@@ -245,9 +593,9 @@ if __name__ == '__main__':
     assert 'baseline' in data
     assert 'n_grey' in data['baseline']
 
-    # Extract the directory where we'll be saving the data, and the name of the file.
-    path = args.data[:args.data.rfind('/')]
-    assert os.path.isdir(path)  # TODO: Unnecessary?
-    filename = args.data[args.data.rfind('/')+1:args.data.find('_data')]
+    # Extract the directory where we'll be saving the metrics, and the name of the file (without '_data').
+    path = os.path.dirname(os.path.abspath(args.data))
+    filename = os.path.splitext(os.path.basename(args.data))[0].split('_data')[0]
 
-    main(data, path, filename)
+    main(handle, path, filename, args.data, args.metrics, args.workers, args.plugins, not args.no_cache, windows,
+         bin_size, step)
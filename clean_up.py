@@ -2,11 +2,12 @@ import os
 import argparse
 import configparser
 import json
-from utilities import natural_sorting
+from utilities import natural_sorting, resolve_metadata, METADATA_DIR
+from spike_store import read_data, write_data, concat_tables, session_record
 import shutil
 
 
-def main(project_dir, date):
+def main(project_dir, date, output_format='npz'):
     # TODO: Maybe add checks to ensure params.json and config.ini information match?
 
     # Get names of all directories with the specified 'date'.
@@ -20,38 +21,45 @@ def main(project_dir, date):
 
         with open(os.path.join(project_dir, 'proc', d + '_parameters.json')) as f:
             parameters = json.load(f)
+        resolve_metadata(parameters, os.path.join(project_dir, 'proc', METADATA_DIR))
 
         # Check if the temp folder where all the individual spike files live exists.
         assert os.path.isdir(os.path.join(project_dir, 'temp', d))
 
         # Get names of all the individual spike files.
         with os.scandir(os.path.join(project_dir, 'temp', d)) as it:
-            spk_files = [entry.name for entry in it if (entry.name.startswith('spk_') and entry.name.endswith('.json'))]
+            spk_files = [entry.name for entry in it if (entry.name.startswith('spk_') and entry.name.endswith('.npz'))]
         spk_files.sort(key=natural_sorting)
 
         # Check if files for all channels are present.
         # assert len(spk_files) == parameters['n_channels']  # TODO: Add it after finishing testing
 
-        # Loop through all spike files and populate them in parameters.
+        # Load all spike files and stack them in parameters.
+        spikes, baseline = [], []
         for file in spk_files:
-            with open(os.path.join(project_dir, 'temp', d, file)) as f:
-                spk_data = json.load(f)
-                assert 'spikes' in spk_data
-                assert 'baseline' in spk_data
-                for key, value in spk_data['spikes'].items():
-                    parameters['spikes'][key] = value
-                for key, value in spk_data['baseline'].items():
-                    parameters['baseline']['spikes'][key] = value
-            os.remove(os.path.join(project_dir, 'temp', d, file))
+            spk_data = read_data(os.path.join(project_dir, 'temp', d, file), packed=True)
+            assert 'spikes' in spk_data
+            assert 'baseline' in spk_data
+            spikes.append(spk_data['spikes'])
+            baseline.append(spk_data['baseline']['spikes'])
+        if spk_files:
+            parameters['spikes'] = concat_tables(spikes)
+            parameters['baseline']['spikes'] = concat_tables(baseline)
+            # Identify the session by its spikes, so results computed from it can be cached.
+            parameters['sessions'] = [session_record(d, parameters['spikes'], parameters['baseline']['spikes'])]
+
+        write_data(os.path.join(project_dir, 'proc', d + '_data.' + output_format), parameters)
 
-        with open(os.path.join(project_dir, 'proc', d + '_data.json'), 'w') as f:
-            json.dump(parameters, f, indent=4)
+        for file in spk_files:
+            os.remove(os.path.join(project_dir, 'temp', d, file))
 
         # Delete the individual spike files.
         os.rmdir(os.path.join(project_dir, 'temp', d))
 
-        # Delete params file.
+        # Delete params files.
         os.remove(os.path.join(project_dir, 'proc', d + '_parameters.json'))
+        if os.path.isfile(os.path.join(project_dir, 'proc', d + '_parameters.npz')):
+            os.remove(os.path.join(project_dir, 'proc', d + '_parameters.npz'))
 
     # Delete main temp directory
     shutil.rmtree(os.path.join(project_dir, 'temp'), ignore_errors=True)
@@ -64,6 +72,8 @@ if __name__ == '__main__':
     # TODO: Think of a better way to get access to this information than re-reading config
     parser.add_argument('--config', type=str, help='full path and name of the .ini file '
                                                    'defining the experiment parameters')
+    parser.add_argument('--format', type=str, default='npz', choices=['npz', 'json'],
+                        help='format of the session data files: binary spike store (npz), or nested JSON')
 
     args = parser.parse_args()
 
@@ -81,4 +91,4 @@ if __name__ == '__main__':
     date = date[0][-2:] + date[1] + date[2]
     project_dir = config['File IO']['project_dir']
 
-    main(project_dir, date)
+    main(project_dir, date, args.format)
@@ -1,80 +1,93 @@
 import os
-import sys
 import json
-from utilities import read_json
-
-
-def main(files):
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from numpy import array, nonzero
+from spike_store import SessionData, DataWriter, concat_trials
+
+
+# Fields that must be present in all files, and fields whose values must match across all files.
+# TODO: Check if neuroid ids match too?
+_REQUIRED_FIELDS = ['experiment_name', 'experiment_paradigm', 'date', 'neuroid', 'neuroid/animal', 'f_sampling',
+                    'f_low', 'f_high', 'ellip_order', 'threshold_sd', 'chunks_for_threshold', 'start_time',
+                    'stop_time', 'baseline', 'baseline/n_grey', 'baseline/n_other', 'n_trials', 'n_channels',
+                    'stim_on_time', 'stim_off_time', 'stim_on_delay', 'inter_trial_interval', 'stim_size',
+                    'fixation_point_size', 'fixation_window_size']
+_MATCHING_FIELDS = ['experiment_name', 'experiment_paradigm', 'neuroid/animal', 'f_sampling', 'f_low', 'f_high',
+                    'ellip_order', 'threshold_sd', 'chunks_for_threshold', 'start_time', 'stop_time', 'n_channels',
+                    'stim_on_time', 'stim_off_time', 'stim_on_delay', 'inter_trial_interval', 'stim_size',
+                    'fixation_point_size', 'fixation_window_size', 'baseline/n_grey', 'baseline/n_other']
+_REQUIRED_TABLES = ['spikes', 'baseline/spikes']
+
+
+def _field(metadata, field):
+    for key in field.split('/'):
+        if not isinstance(metadata, dict) or key not in metadata:
+            raise KeyError(field)
+        metadata = metadata[key]
+    return metadata
+
+
+def _open(file):
+    try:
+        return SessionData(file)
+    except Exception as e:
+        raise Exception('%s: could not be loaded (%r)' % (file, e))
+
+
+def _validate(files, handles):
+    """Check the headers of all session files in one go, and report every problem along with its file."""
+    problems = []
+
+    # Check if necessary fields are present in all files.
+    for file, handle in zip(files, handles):
+        for field in _REQUIRED_FIELDS:
+            try:
+                _field(handle.metadata, field)
+            except KeyError:
+                problems.append('%s: missing field %s' % (file, field))
+        for table in _REQUIRED_TABLES:
+            if table not in handle.tables:
+                problems.append('%s: missing spike table %s' % (file, table))
+    assert not problems, '\n'.join(problems)
+
+    # Check if necessary field values match in all files, comparing a (file, field) table of values against the
+    # first file.
+    values = array([[json.dumps(_field(handle.metadata, field), sort_keys=True) for field in _MATCHING_FIELDS]
+                    for handle in handles])
+    for i, j in zip(*nonzero(values != values[0])):
+        problems.append('%s: %s does not match %s' % (files[i], _MATCHING_FIELDS[j], files[0]))
+    assert not problems, '\n'.join(problems)
+
+
+def main(files, output='data.npz', workers=8):
     # We're done if there's only one file.
     if len(files) == 1:
         return
 
     # Check if files exist.
     for file in files:
-        assert os.path.isfile(file)
-
-    data = []
-    for i, file in enumerate(files):
-        # Load files.
-        data.append(read_json(file))
-        # Check if necessary fields are present in all files.
-        # TODO: Maybe make a function to do this, since it's used often? Also, is this really necessary here?
-        assert 'experiment_name' in data[i]
-        assert 'experiment_paradigm' in data[i]
-        assert 'date' in data[i]
-        assert 'neuroid' in data[i]
-        assert 'animal' in data[i]['neuroid']
-        assert 'f_sampling' in data[i]
-        assert 'f_low' in data[i]
-        assert 'f_high' in data[i]
-        assert 'ellip_order' in data[i]
-        assert 'threshold_sd' in data[i]
-        assert 'chunks_for_threshold' in data[i]
-        assert 'start_time' in data[i]
-        assert 'stop_time' in data[i]
-        assert 'spikes' in data[i]
-        assert 'baseline' in data[i]
-        assert 'spikes' in data[i]['baseline']
-        assert 'n_grey' in data[i]['baseline']
-        assert 'n_other' in data[i]['baseline']
-        assert 'n_trials' in data[i]
-        assert 'n_channels' in data[i]
-        assert 'stim_on_time' in data[i]
-        assert 'stim_off_time' in data[i]
-        assert 'stim_on_delay' in data[i]
-        assert 'inter_trial_interval' in data[i]
-        assert 'stim_size' in data[i]
-        assert 'fixation_point_size' in data[i]
-        assert 'fixation_window_size' in data[i]
-
-    # Check if necessary field values match in all files.
-    # TODO: Check if neuroid ids match too?
-    assert all(session_data['experiment_name'] == data[0]['experiment_name'] for session_data in data)
-    assert all(session_data['experiment_paradigm'] == data[0]['experiment_paradigm'] for session_data in data)
-    assert all(session_data['neuroid']['animal'] == data[0]['neuroid']['animal'] for session_data in data)
-    assert all(session_data['f_sampling'] == data[0]['f_sampling'] for session_data in data)
-    assert all(session_data['f_low'] == data[0]['f_low'] for session_data in data)
-    assert all(session_data['f_high'] == data[0]['f_high'] for session_data in data)
-    assert all(session_data['ellip_order'] == data[0]['ellip_order'] for session_data in data)
-    assert all(session_data['threshold_sd'] == data[0]['threshold_sd'] for session_data in data)
-    assert all(session_data['chunks_for_threshold'] == data[0]['chunks_for_threshold'] for session_data in data)
-    assert all(session_data['start_time'] == data[0]['start_time'] for session_data in data)
-    assert all(session_data['stop_time'] == data[0]['stop_time'] for session_data in data)
-    assert all(session_data['n_channels'] == data[0]['n_channels'] for session_data in data)
-    assert all(session_data['stim_on_time'] == data[0]['stim_on_time'] for session_data in data)
-    assert all(session_data['stim_off_time'] == data[0]['stim_off_time'] for session_data in data)
-    assert all(session_data['stim_on_delay'] == data[0]['stim_on_delay'] for session_data in data)
-    assert all(session_data['inter_trial_interval'] == data[0]['inter_trial_interval'] for session_data in data)
-    assert all(session_data['stim_size'] == data[0]['stim_size'] for session_data in data)
-    assert all(session_data['fixation_point_size'] == data[0]['fixation_point_size'] for session_data in data)
-    assert all(session_data['fixation_window_size'] == data[0]['fixation_window_size'] for session_data in data)
-    assert all(session_data['baseline']['n_grey'] == data[0]['baseline']['n_grey'] for session_data in data)
-    assert all(session_data['baseline']['n_other'] == data[0]['baseline']['n_other'] for session_data in data)
+        assert os.path.isfile(file), file
+
+    # Open (and parse the metadata of) all files in parallel. Binary files are memory-mapped by threads, and their
+    # spikes are loaded one neuroid at a time when they are merged. JSON files have to be parsed in full, which
+    # holds the GIL, so they are parsed by a pool of processes; their packed spike tables come back from there.
+    npz_files = [_ for _ in files if _.lower().endswith('.npz')]
+    json_files = [_ for _ in files if _ not in npz_files]
+    handles = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        handles.update(zip(npz_files, executor.map(_open, npz_files)))
+    if json_files:
+        with ProcessPoolExecutor(max_workers=min(workers, len(json_files))) as executor:
+            handles.update(zip(json_files, executor.map(_open, json_files)))
+    handles = [handles[_] for _ in files]
+    _validate(files, handles)
+    data = [handle.metadata for handle in handles]
 
     # Populate the new dictionary which will contain all the merged data.
     concatenated_data = dict()
     for key, value in data[0].items():
-        if key in ['spikes', 'baseline', 'trial_times', 'date', 'n_trials']:
+        if key in ['spikes', 'baseline', 'trial_times', 'date', 'n_trials', 'sessions']:
             continue
         concatenated_data[key] = value
 
@@ -85,6 +98,9 @@ def main(files):
     # Merge the number of trials.
     concatenated_data['n_trials'] = sum(session_data['n_trials'] for session_data in data)
 
+    # List the sessions the trials come from, in order.
+    concatenated_data['sessions'] = [session for handle in handles for session in handle.sessions()]
+
     # Create a grouping_idx field so it is easy to identify which trials were run on which days
     # for normalization purposes.
     grouping_dates = []  # Temporary list of dates used to compute groupings
@@ -106,47 +122,30 @@ def main(files):
     assert len(grouping) == len(concatenated_data['date'].split(','))
     concatenated_data['grouping_idx'] = grouping
 
-    # Merge spikes.
-    # TODO: a more efficient way?
-    concatenated_data['spikes'] = {}
-    for channel in data[0]['spikes']:
-        concatenated_data['spikes'][channel] = {}
-        for item in data[0]['spikes'][channel]:
-            _ = {}  # Initialize an empty dictionary that will contain data for all trials.
-            trial_counter = 0  # Initialize a counter for trial number.
-            for session_data in data:
-                for trial_data in session_data['spikes'][channel][item].values():
-                    trial_counter += 1
-                    _[trial_counter] = trial_data
-            concatenated_data['spikes'][channel][item] = _
-
-    # Merge baseline.
+    # Merge baseline metadata.
     concatenated_data['baseline'] = {}
     concatenated_data['baseline']['n_grey'] = data[0]['baseline']['n_grey']
     concatenated_data['baseline']['n_other'] = data[0]['baseline']['n_other']
 
-    concatenated_data['baseline']['spikes'] = {}
-    for channel in data[0]['baseline']['spikes']:
-        concatenated_data['baseline']['spikes'][channel] = {}
-        for item in data[0]['baseline']['spikes'][channel]:
-            _ = {}  # Initialize an empty dictionary that will contain data for all trials.
-            trial_counter = 0  # Initialize a counter for trial number.
-            for session_data in data:
-                for trial_data in session_data['baseline']['spikes'][channel][item].values():
-                    trial_counter += 1
-                    _[trial_counter] = trial_data
-            concatenated_data['baseline']['spikes'][channel][item] = _
-
-    # Store data.
-    with open('data.json', 'w') as f:
-        json.dump(concatenated_data, f, indent=4)  # TODO: Store in a braintree directory?
+    # Merge spikes and baseline spikes, one neuroid at a time, and store data as we go.
+    with DataWriter(output, concatenated_data) as writer:  # TODO: Store in a braintree directory?
+        for table in ['spikes', 'baseline/spikes']:
+            for channel in handles[0].neuroids(table):
+                writer.add(table, concat_trials([handle.table(table, [channel]) for handle in handles]))
 
     return
 
 
 if __name__ == '__main__':
-    assert len(sys.argv) > 1
-    main(sys.argv[1:])
+    parser = argparse.ArgumentParser(description='Multi-unit activity analysis tools.')
+    parser.add_argument('files', nargs='+', help='session data files (.npz or .json) to concatenate')
+    parser.add_argument('--output', type=str, default='data.npz',
+                        help='name of the concatenated data file; written as JSON if it ends in .json')
+    parser.add_argument('--workers', type=int, default=8, help='number of files to load in parallel (JSON files '
+                                                                'are parsed in separate processes)')
+    args = parser.parse_args()
+
+    main(args.files, args.output, args.workers)
 
     # concat_data('/Volumes/data2/active/users/sachis/projects/test/monkeys/solo/proc/solo_fbop_181229_100311_data.json',
     #             '/Volumes/data2/active/users/sachis/projects/test/monkeys/solo/proc/solo_fbop_181229_100311_data.json')
@@ -3,9 +3,153 @@ import argparse
 import os
 import re
 from scipy.io import loadmat
-from numpy import where, bincount, fromfile, nonzero
+from numpy import bincount, array, arange
 import json
-from utilities import natural_sorting, read_rhd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import repeat
+from utilities import natural_sorting, read_rhd_file, intan_header_file, memmap_channel, store_filter_designs, \
+    digital_edges, correct_presentations, trial_table, store_metadata, resolve_metadata, FILTER_DESIGNS_FILE, \
+    atomic_open, METADATA_DIR, METADATA_KEYS
+from spike_store import write_parameters
+
+
+def _trial_times(items, onsets):
+    """Nested trial_times[item][trial] (trials numbered from 1) of a dense (item, trial) array of onsets."""
+    return {item: dict(zip(range(1, onsets.shape[1] + 1), row)) for item, row in zip(items.tolist(), onsets.tolist())}
+
+
+def _check_session(project_dir, d):
+    """Read the Intan header of session directory `d`; returns the header and a list of problems found with it."""
+    try:
+        # Recordings are either an info.rhd header with one file per channel, or a single .rhd file.
+        header = read_rhd_file(intan_header_file(os.path.join(project_dir, 'intanraw', d)))
+    except Exception as e:
+        return None, ['%s: cannot read the Intan header (%s)' % (d, e)]
+
+    problems = []
+    if header['num_amplifier_channels'] == 0:
+        problems.append('%s: no amplifier channels' % d)
+    if header['num_board_dig_in_channels'] != 2:
+        problems.append('%s: %d digital inputs instead of 2' % (d, header['num_board_dig_in_channels']))
+    return header, problems
+
+
+def _process_session(d, mfile, header, parameters, baseline, settings):
+    """Create and save the metadata structure of session directory `d`; returns its sampling rate."""
+    project_dir = settings['project_dir']
+    # Start from a copy of the experiment-wide parameters, so sessions do not share any state. These refer to the
+    # image and array metadata by hash; look the metadata up (only once per process).
+    references = {key: parameters[key] for key in METADATA_KEYS}
+    parameters = resolve_metadata(dict(parameters), os.path.join(project_dir, 'proc', METADATA_DIR))
+
+    # Get experimental sampling rate and channel count information (the header was parsed during the checks).
+    parameters['f_sampling'] = header['sample_rate']
+    parameters['n_channels'] = header['num_amplifier_channels']
+
+    # Check if channel count information from array metadata matches experimental output.
+    assert parameters['n_channels'] == len(parameters['neuroid']['neuroid_id'])
+
+    # Get information on number of trials from MWorks data.
+    behavior_data = loadmat(os.path.join(project_dir, 'mworksproc', mfile), squeeze_me=True)
+    assert 'fixation_correct' in behavior_data.keys()
+    assert 'image_order' in behavior_data.keys()
+    fixation_correct = behavior_data['fixation_correct']
+    image_order = behavior_data['image_order']
+
+    # Group correct trials by item (in one go), and count them.
+    item_ids = array(list(parameters['item']['id'].values()))
+    _, _, repetition_count = correct_presentations(image_order, fixation_correct, item_ids)
+    most_frequent_rep_num = bincount(repetition_count).argmax()
+
+    parameters['n_trials'] = int(most_frequent_rep_num)  # Convert from numpy.int64 to int for JSON serialization
+
+    # Get information on experiment settings from MWorks data.
+    assert 'meta' in behavior_data.keys()
+    parameters['stim_on_time'] = behavior_data['meta']['stim_on_time'].item()
+    parameters['stim_off_time'] = behavior_data['meta']['stim_off_time'].item()
+    parameters['stim_on_delay'] = behavior_data['meta']['stim_on_delay'].item()
+    parameters['inter_trial_interval'] = behavior_data['meta']['inter_trial_interval'].item()
+    parameters['stim_size'] = behavior_data['meta']['stim_size'].item()
+    parameters['fixation_point_size'] = behavior_data['meta']['fixation_point_size'].item()
+    parameters['fixation_window_size'] = behavior_data['meta']['fixation_window_size'].item()
+
+    # Create a "spikes" field in the parameters dictionary so it can be populated easily later.
+    parameters['spikes'] = {}
+
+    # Create a "baseline" field in the parameters dictionary so it can be populated easily later.
+    parameters['baseline'] = {}
+    parameters['baseline']['spikes'] = {}
+
+    # Get all trial time information: look for 0->1 transitions (indexes of the first 1s), streaming through the
+    # memory-mapped digital input.
+    din02 = memmap_channel(os.path.join(project_dir, 'intanraw', d), 'DIGITAL-IN-02')
+    samp_on = digital_edges(din02, 'rising')
+    # Divide by sampling rate to get correct unit of time (in seconds).
+    samp_on = samp_on / parameters['f_sampling']
+
+    # Merge and store trial time data: onsets of the first n_trials correct trials of each item, as a dense
+    # (item, trial) array.
+    trial_onsets = samp_on[trial_table(image_order, fixation_correct, item_ids, parameters['n_trials'])]
+    parameters['trial_times'] = _trial_times(item_ids, trial_onsets)
+
+    # Store baseline metadata.
+    # TODO: Add stimulus category names information
+    parameters['baseline']['n_grey'] = baseline['n_grey']
+    parameters['baseline']['n_other'] = baseline['n_other']
+
+    # Check whether item IDs are zero-indexed or not, because that will affect how we compute
+    # the IDs for baseline images.
+    is_zero_indexed = False
+    if parameters['item']['id']['0'] == 0:
+        is_zero_indexed = True
+
+    # Store trial time data for baseline images.
+    baseline_ids = arange(len(parameters['item']['id']) + int(not is_zero_indexed),
+                          len(parameters['item']['id']) + parameters['baseline']['n_grey']
+                          + parameters['baseline']['n_other'] + int(not is_zero_indexed))
+    baseline_onsets = samp_on[trial_table(image_order, fixation_correct, baseline_ids, parameters['n_trials'])]
+    parameters['baseline']['trial_times'] = _trial_times(baseline_ids, baseline_onsets)
+
+    # Store all params in the parameters dict too so that methods that work on top of it know where to look
+    # without accessing the config file.
+    parameters.update(settings)
+
+    # Remove the binary parameters of an earlier run first, so they are never taken for those of this one.
+    if os.path.isfile(os.path.join(project_dir, 'proc', d + '_parameters.npz')):
+        os.remove(os.path.join(project_dir, 'proc', d + '_parameters.npz'))
+
+    # Store data, referring to the metadata by hash again.
+    with open(os.path.join(project_dir, 'proc', d + '_parameters.json'), 'w') as f:
+        json.dump(dict(parameters, **references), f, indent=4)  # TODO: Store in a braintree directory
+
+    # Store what spike detection needs in the binary parameters format too, so its (many) jobs only read a header
+    # and the memory-mapped trial onsets. It is written last, and records the size and modification time of the JSON
+    # file, so jobs can check that the two files belong together with a stat.
+    stat = os.stat(os.path.join(project_dir, 'proc', d + '_parameters.json'))
+    with atomic_open(os.path.join(project_dir, 'proc', d + '_parameters.npz')) as f:
+        write_parameters(f, parameters, trial_onsets, baseline_onsets, (stat.st_size, stat.st_mtime_ns))
+
+    return parameters['f_sampling']
+
+
+def _run_parallel(dirs, mfiles, headers, parameters, baseline, settings, executor):
+    """Spread the session directories over `executor`; returns the sampling rate of each session."""
+    futures = {executor.submit(_process_session, d, mfile, headers[d], parameters, baseline, settings): d
+               for d, mfile in zip(dirs, mfiles)}
+    f_samplings, failures = {}, []
+    for i, future in enumerate(as_completed(futures)):
+        d = futures[future]
+        try:
+            f_samplings[d] = future.result()
+            print('[%d/%d] %s done' % (i + 1, len(futures), d))
+        except Exception as e:
+            failures.append(d)
+            print('[%d/%d] %s failed: %r' % (i + 1, len(futures), d, e))
+
+    if failures:
+        raise Exception('Merge failed for %d of %d sessions: %s' % (len(failures), len(dirs),
+                                                                     ', '.join(sorted(failures, key=natural_sorting))))
+    return [f_samplings[d] for d in dirs]
 
 
 def main():
@@ -13,12 +157,15 @@ def main():
     parser = argparse.ArgumentParser(description='Muli-unit activity analysis tools.')
     parser.add_argument('--config', type=str, help='full path and name of the .ini file '
                                                    'defining the experiment parameters')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of session directories to process in parallel (default: 1)')
     args = parser.parse_args()
 
     # Check if config option is not none.
     assert args.config is not None
     # Check if config file exists.
     assert os.path.isfile(args.config)
+    assert args.workers >= 1
 
     config = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation(),
                                        inline_comment_prefixes=('#', ';'))
@@ -91,15 +238,6 @@ def main():
     dirs.sort(key=natural_sorting)
     assert len(dirs) != 0
 
-    # TODO: maybe a better way for checking this?
-    for _ in dirs:
-        assert os.path.isfile(os.path.join(config['File IO']['project_dir'], 'intanraw', _, 'info.rhd'))
-        f = open(os.path.join(config['File IO']['project_dir'], 'intanraw', _, 'info.rhd'), 'rb')
-        header = read_rhd(f)
-        assert header['num_amplifier_channels'] != 0
-        assert header['num_board_dig_in_channels'] == 2
-        f.close()
-
     # Check if MWorks file for the particular date exists.
     # TODO: Use pymworks or equivalent to unpack .mwk files within this pipeline
     with os.scandir(os.path.join(config['File IO']['project_dir'], 'mworksproc')) as it:
@@ -134,117 +272,55 @@ def main():
     with open(config['Metadata']['array_metadata']) as f:
         parameters['neuroid'] = json.load(f)
 
-    # Loop through each directory, and create and save a metadata structure.
-    for i, d in enumerate(dirs):
-        # Get experimental sampling rate and channel count information.
-        f = open(os.path.join(config['File IO']['project_dir'], 'intanraw', d, 'info.rhd'), 'rb')
-        header = read_rhd(f)
-        f.close()
-
-        parameters['f_sampling'] = header['sample_rate']
-        parameters['n_channels'] = header['num_amplifier_channels']
-
-        # Check if channel count information from array metadata matches experimental output.
-        assert parameters['n_channels'] == len(parameters['neuroid']['neuroid_id'])
-
-        # Get information on number of trials from MWorks data.
-        behavior_data = loadmat(os.path.join(config['File IO']['project_dir'], 'mworksproc', mfiles[i]),
-                                squeeze_me=True)
-        assert 'fixation_correct' in behavior_data.keys()
-        assert 'image_order' in behavior_data.keys()
-        fixation_correct = behavior_data['fixation_correct']
-        image_order = behavior_data['image_order']
-
-        correct_trials = image_order[where(fixation_correct == 1)]
-
-        repetition_count = []
-        for _, item in parameters['item']['id'].items():
-            repetition_count.append(len(correct_trials[correct_trials == item]))
-        most_frequent_rep_num = bincount(repetition_count).argmax()
-
-        parameters['n_trials'] = int(most_frequent_rep_num)  # Convert from numpy.int64 to int for JSON serialization
-
-        # Get information on experiment settings from MWorks data.
-        assert 'meta' in behavior_data.keys()
-        parameters['stim_on_time'] = behavior_data['meta']['stim_on_time'].item()
-        parameters['stim_off_time'] = behavior_data['meta']['stim_off_time'].item()
-        parameters['stim_on_delay'] = behavior_data['meta']['stim_on_delay'].item()
-        parameters['inter_trial_interval'] = behavior_data['meta']['inter_trial_interval'].item()
-        parameters['stim_size'] = behavior_data['meta']['stim_size'].item()
-        parameters['fixation_point_size'] = behavior_data['meta']['fixation_point_size'].item()
-        parameters['fixation_window_size'] = behavior_data['meta']['fixation_window_size'].item()
-
-        # Create a "spikes" field in the parameters dictionary so it can be populated easily later.
-        parameters['spikes'] = {}
-
-        # Create a "baseline" field in the parameters dictionary so it can be populated easily later.
-        parameters['baseline'] = {}
-        parameters['baseline']['spikes'] = {}
-
-        # Get all trial time information.
-        filename = os.path.join(config['File IO']['project_dir'], 'intanraw', d,
-                                'board-DIGITAL-IN-02.dat')  # TODO: Add check for existence of file
-        fid = open(filename, 'r')
-        filesize = os.path.getsize(filename)  # in bytes
-        num_samples = filesize // 2  # uint16 = 2 bytes
-        din02 = fromfile(fid, 'uint16', num_samples)
-        fid.close()
-
-        # Look for 0->1 transitions.
-        samp_on, = nonzero(din02[:-1] < din02[1:])
-        # Previous line returns indexes of 0s seen before spikes, but we want indexes of first spikes.
-        samp_on = samp_on + 1
-        # Divide by sampling rate to get correct unit of time (in seconds).
-        samp_on = samp_on / parameters['f_sampling']
-
-        # Merge and store trial time data.
-        parameters['trial_times'] = {}
-        for _, item in parameters['item']['id'].items():
-            parameters['trial_times'][item] = {}
-            rows = where((image_order == item) & (fixation_correct == 1))[0]
-            for trial in range(parameters['n_trials']):
-                parameters['trial_times'][item][trial+1] = samp_on[rows[trial]]  # +1 to get around zero-indexing
-
-        # Store baseline metadata.
-        # TODO: Add stimulus category names information
-        parameters['baseline']['n_grey'] = config.getint('Baseline', 'n_grey')
-        parameters['baseline']['n_other'] = config.getint('Baseline', 'n_other')
-
-        # Check whether item IDs are zero-indexed or not, because that will affect how we compute
-        # the IDs for baseline images.
-        is_zero_indexed = False
-        if parameters['item']['id']['0'] == 0:
-            is_zero_indexed = True
-
-        # Store trial time data for baseline images.
-        parameters['baseline']['trial_times'] = {}
-        for baseline_item in range(len(parameters['item']['id']) + int(not is_zero_indexed),
-                                   len(parameters['item']['id']) + parameters['baseline']['n_grey']
-                                   + parameters['baseline']['n_other'] + int(not is_zero_indexed)):
-            parameters['baseline']['trial_times'][baseline_item] = {}
-            rows = where((image_order == baseline_item) & (fixation_correct == 1))[0]
-            for trial in range(parameters['n_trials']):
-                parameters['baseline']['trial_times'][baseline_item][trial+1] = samp_on[rows[trial]]  # +1 to get around zero-indexing
-
-        # Store all params in the parameters dict too so that methods that work on top of it know where to look
-        # without accessing the config file.
-        # TODO: Do this earlier?
-        parameters['project_dir'] = config['File IO']['project_dir']
-        parameters['threshold_sd'] = config.getfloat('Thresholding', 'threshold_sd')
-        parameters['chunks_for_threshold'] = config.getint('Thresholding', 'chunks_for_threshold')
-        parameters['f_low'] = config.getfloat('Filtering', 'f_low')
-        parameters['f_high'] = config.getfloat('Filtering', 'f_high')
-        parameters['ellip_order'] = config.getint('Filtering', 'ellip_order')
-        parameters['start_time'] = config.getfloat('Detection', 'start_time')
-        parameters['stop_time'] = config.getfloat('Detection', 'stop_time')
-
-        # Make proc directory if it does not exist.
-        if not os.path.isdir(os.path.join(config['File IO']['project_dir'], 'proc')):
-            os.mkdir(os.path.join(config['File IO']['project_dir'], 'proc'))
-
-        # Store data.
-        with open(os.path.join(config['File IO']['project_dir'], 'proc', d + '_parameters.json'), 'w') as f:
-            json.dump(parameters, f, indent=4)  # TODO: Store in a braintree directory
+    # Store all params in the parameters dict too so that methods that work on top of it know where to look
+    # without accessing the config file.
+    # TODO: Do this earlier?
+    settings = dict()
+    settings['project_dir'] = config['File IO']['project_dir']
+    settings['threshold_sd'] = config.getfloat('Thresholding', 'threshold_sd')
+    settings['chunks_for_threshold'] = config.getint('Thresholding', 'chunks_for_threshold')
+    settings['f_low'] = config.getfloat('Filtering', 'f_low')
+    settings['f_high'] = config.getfloat('Filtering', 'f_high')
+    settings['ellip_order'] = config.getint('Filtering', 'ellip_order')
+    settings['start_time'] = config.getfloat('Detection', 'start_time')
+    settings['stop_time'] = config.getfloat('Detection', 'stop_time')
+
+    baseline = {'n_grey': config.getint('Baseline', 'n_grey'), 'n_other': config.getint('Baseline', 'n_other')}
+
+    # Make proc directory if it does not exist.
+    if not os.path.isdir(os.path.join(settings['project_dir'], 'proc')):
+        os.mkdir(os.path.join(settings['project_dir'], 'proc'))
+
+    # Store the image and array metadata once, instead of copying it into the parameters of every session.
+    for key in METADATA_KEYS:
+        parameters[key] = store_metadata(os.path.join(settings['project_dir'], 'proc', METADATA_DIR), parameters[key])
+
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    try:
+        # Check the Intan headers of all directories before processing any of them, and report every problem found.
+        if executor is None:
+            checks = [_check_session(settings['project_dir'], d) for d in dirs]
+        else:
+            checks = list(executor.map(_check_session, repeat(settings['project_dir']), dirs))
+        problems = [problem for _, session_problems in checks for problem in session_problems]
+        assert not problems, 'Invalid Intan recordings:\n' + '\n'.join(problems)
+        headers = {d: header for d, (header, _) in zip(dirs, checks)}
+
+        # Loop through each directory, and create and save a metadata structure.
+        if executor is None:
+            f_samplings = [_process_session(d, mfile, headers[d], parameters, baseline, settings)
+                           for d, mfile in zip(dirs, mfiles)]
+        else:
+            f_samplings = _run_parallel(dirs, mfiles, headers, parameters, baseline, settings, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # Store the filter designs too, so spk_detect.py (and any re-runs) do not have to design them again. This is done
+    # once all sessions are merged, so parallel sessions never write the designs file at the same time.
+    for f_sampling in sorted(set(f_samplings)):
+        store_filter_designs(os.path.join(settings['project_dir'], 'proc', FILTER_DESIGNS_FILE), f_sampling,
+                             settings['f_low'], settings['f_high'], settings['ellip_order'])
 
 
 if __name__ == '__main__':
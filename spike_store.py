@@ -0,0 +1,485 @@
+import os
+import sys
+import json
+import hashlib
+import re
+import shutil
+import struct
+import tempfile
+import zipfile
+from numpy import array, asarray, concatenate, cumsum, fromiter, frombuffer, split, savez, load, memmap, empty, \
+    diff, repeat, arange, argsort, uint8, int64, float64
+from numpy.lib import format as npy_format
+
+# Where spike tables live in a data file. Spike files written by spk_detect.py use the same layout.
+SPIKE_TABLES = [('spikes',), ('baseline', 'spikes')]
+
+
+def make_table(neuroid, item, trial, times, offsets):
+    """Put together a packed spike table.
+
+    Spike times for every (neuroid, item, trial) are stored flat in `times`, CSR
+    style: the spikes of the cell at flat index i of the (neuroid, item, trial) grid
+    are times[offsets[i]:offsets[i + 1]].
+    """
+    table = {'neuroid': array([str(_) for _ in neuroid], dtype=str),
+             'item': array([str(_) for _ in item], dtype=str),
+             'trial': array([str(_) for _ in trial], dtype=str),
+             'times': asarray(times, dtype=float64),
+             'offsets': asarray(offsets, dtype=int64)}
+    assert len(table['offsets']) == len(table['neuroid']) * len(table['item']) * len(table['trial']) + 1
+    return table
+
+
+def pack_spikes(spikes):
+    """Convert nested spikes[neuroid][item][trial] -> list of spike times into a packed spike table."""
+    neuroid = list(spikes)
+    item = list(spikes[neuroid[0]]) if neuroid else []
+    trial = list(spikes[neuroid[0]][item[0]]) if item else []
+
+    # The (neuroid, item, trial) grid has to be rectangular.
+    assert all(list(spikes[n]) == item for n in neuroid)
+    assert all(list(spikes[n][i]) == trial for n in neuroid for i in item)
+
+    cells = [spikes[n][i][t] for n in neuroid for i in item for t in trial]
+    counts = fromiter((len(_) for _ in cells), dtype=int64, count=len(cells))
+    times = fromiter((x for cell in cells for x in cell), dtype=float64, count=counts.sum())
+    return make_table(neuroid, item, trial, times, concatenate(([0], cumsum(counts))))
+
+
+def unpack_spikes(table):
+    """Convert a packed spike table back into nested spikes[neuroid][item][trial] -> list of spike times."""
+    cells = iter(split(table['times'], table['offsets'][1:-1]) if len(table['offsets']) > 1 else [])
+    spikes = {}
+    for n in table['neuroid'].tolist():
+        spikes[n] = {}
+        for i in table['item'].tolist():
+            spikes[n][i] = {}
+            for t in table['trial'].tolist():
+                spikes[n][i][t] = next(cells).tolist()
+    return spikes
+
+
+def concat_tables(tables):
+    """Stack packed spike tables for different neuroids (with the same items and trials) into one."""
+    assert len(tables) != 0
+    assert all((_['item'] == tables[0]['item']).all() and (_['trial'] == tables[0]['trial']).all() for _ in tables)
+    starts = cumsum([0] + [len(_['times']) for _ in tables[:-1]])
+    return make_table(concatenate([_['neuroid'] for _ in tables]), tables[0]['item'], tables[0]['trial'],
+                      concatenate([_['times'] for _ in tables]),
+                      concatenate([[0]] + [_['offsets'][1:] + start for _, start in zip(tables, starts)]))
+
+
+def select_neuroids(table, neuroids=None):
+    """Copy of packed spike `table` with only the given neuroids (all of them by default), in the given order.
+
+    Only the spikes of the selected neuroids are read, so this works well on memory-mapped tables.
+    """
+    if neuroids is None:
+        neuroids = table['neuroid'].tolist()
+    n_cells = len(table['item']) * len(table['trial'])
+    index = {neuroid: i for i, neuroid in enumerate(table['neuroid'].tolist())}
+
+    times, offsets, n_times = [], [[0]], 0
+    for neuroid in neuroids:
+        # All cells of a neuroid are stored one after another.
+        start = index[neuroid] * n_cells
+        cell_offsets = asarray(table['offsets'][start:start + n_cells + 1])
+        times.append(asarray(table['times'][cell_offsets[0]:cell_offsets[-1]]))
+        offsets.append(cell_offsets[1:] - cell_offsets[0] + n_times)
+        n_times += len(times[-1])
+    return make_table(neuroids, table['item'], table['trial'], concatenate(times) if times else [],
+                      concatenate(offsets))
+
+
+def select_trials(table, start, stop):
+    """Copy of packed spike `table` with only trials start..stop-1 (by position).
+
+    Only the offsets and spikes of the selected trials are read, so this works well on memory-mapped tables.
+    """
+    n_rows, n_trials = len(table['neuroid']) * len(table['item']), len(table['trial'])
+    # Offsets of the selected cells of every (neuroid, item) row, along with the end of the last one.
+    cell_offsets = asarray(table['offsets'])[(arange(n_rows) * n_trials)[:, None] + arange(start, stop + 1)]
+    counts = diff(cell_offsets, axis=1)
+
+    # The selected spikes of every (neuroid, item) row form a contiguous run, so gather all runs in one pass.
+    lo = cell_offsets[:, 0]
+    row_counts = counts.sum(axis=1)
+    row_starts = concatenate(([0], cumsum(row_counts)[:-1]))
+    idxs = arange(row_counts.sum()) - repeat(row_starts - lo, row_counts)
+    return make_table(table['neuroid'], table['item'], table['trial'][start:stop], asarray(table['times'])[idxs],
+                      concatenate(([0], cumsum(counts.ravel()))))
+
+
+def table_digest(tables):
+    """SHA-1 hex digest of the contents of packed spike tables, identifying the spike data of a session."""
+    digest = hashlib.sha1()
+    for table in tables:
+        for key in ['neuroid', 'item', 'trial']:
+            digest.update('\0'.join(table[key].tolist()).encode() + b'\1')
+        digest.update(asarray(table['times'], dtype=float64).tobytes())
+        digest.update(asarray(table['offsets'], dtype=int64).tobytes())
+    return digest.hexdigest()
+
+
+def session_record(name, spikes, baseline_spikes):
+    """Record of a session in a data file: its name, a digest of its spike tables, and its numbers of trials."""
+    return {'name': name, 'hash': table_digest([spikes, baseline_spikes]), 'n_trials': len(spikes['trial']),
+            'n_baseline_trials': len(baseline_spikes['trial'])}
+
+
+def concat_trials(tables):
+    """Join packed spike tables (of the same neuroids and items) along the trial axis.
+
+    Trials are taken from each table in turn, and renumbered 1..n.
+    """
+    assert len(tables) != 0
+    first = tables[0]
+    assert all((_['neuroid'] == first['neuroid']).all() and (_['item'] == first['item']).all() for _ in tables)
+    n_rows = len(first['neuroid']) * len(first['item'])
+
+    # Spikes are stored (neuroid, item) row by row, so sort them by row, and then by table (stable sort keeps trial
+    # order within a table).
+    counts, keys = [], []
+    for i, table in enumerate(tables):
+        counts.append(diff(table['offsets']).reshape(n_rows, len(table['trial'])))
+        keys.append(repeat(arange(n_rows) * len(tables) + i, counts[-1].sum(axis=1)))
+    order = argsort(concatenate(keys), kind='stable')
+    counts = concatenate(counts, axis=1)
+
+    return make_table(first['neuroid'], first['item'], range(1, counts.shape[1] + 1),
+                      concatenate([_['times'] for _ in tables])[order], concatenate(([0], cumsum(counts.ravel()))))
+
+
+def _get(data, path):
+    for key in path:
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+
+def _set(data, path, value):
+    for key in path[:-1]:
+        data = data[key]
+    data[path[-1]] = value
+
+
+def _is_table(value):
+    return isinstance(value, dict) and 'offsets' in value and 'times' in value
+
+
+def _map_tables(data, function):
+    """Copy `data`, replacing every spike table with function(table), or dropping it if that returns None.
+
+    Only the dictionaries leading up to the spike tables are copied.
+    """
+    data = dict(data)
+    for path in SPIKE_TABLES:
+        value = _get(data, path)
+        if value is None:
+            continue
+        parent = data
+        for key in path[:-1]:
+            parent[key] = dict(parent[key])
+            parent = parent[key]
+        value = function(value)
+        if value is None:
+            del parent[path[-1]]
+        else:
+            parent[path[-1]] = value
+    return data
+
+
+def write_data(file, data):
+    """Write a data (or spike) file.
+
+    `.npz` files use the binary store: every spike table is written as flat arrays
+    (see `make_table`), and everything else as a JSON metadata blob. Any other
+    extension gets the original (nested) JSON layout. Spike tables in `data` can be
+    either packed or nested.
+    """
+    if not file.lower().endswith('.npz'):
+        with open(file, 'w') as f:
+            json.dump(_map_tables(data, lambda _: unpack_spikes(_) if _is_table(_) else _), f, indent=4)
+        return
+
+    arrays = {}
+    for path in SPIKE_TABLES:
+        value = _get(data, path)
+        if value is not None:
+            table = value if _is_table(value) else pack_spikes(value)
+            for key, column in table.items():
+                arrays['/'.join(path + (key,))] = column
+    metadata = _map_tables(data, lambda _: None)
+    arrays['metadata'] = frombuffer(json.dumps(metadata).encode(), dtype=uint8)
+    savez(file, **arrays)
+
+
+def read_data(file, packed=False):
+    """Read a data (or spike) file written by `write_data` (or an original JSON file).
+
+    Spike tables are returned nested, as in the JSON layout, unless `packed` is
+    set, in which case they are returned as packed spike tables.
+    """
+    assert os.path.isfile(file)
+    if not file.lower().endswith('.npz'):
+        with open(file) as f:
+            data = json.load(f)
+        return _map_tables(data, pack_spikes) if packed else data
+
+    with load(file) as arrays:
+        data = json.loads(arrays['metadata'].tobytes().decode())
+        for path in SPIKE_TABLES:
+            prefix = '/'.join(path) + '/'
+            if prefix + 'offsets' not in arrays.files:
+                continue
+            table = {key: arrays[prefix + key] for key in ['neuroid', 'item', 'trial', 'times', 'offsets']}
+            _set(data, path, table if packed else unpack_spikes(table))
+    return data
+
+
+class DataWriter(object):
+    """Write a data file incrementally, a few neuroids at a time.
+
+    Spike tables are spooled to temporary files next to the output as neuroids are
+    added, and the data file is only put together when the writer is closed, so no
+    more than one batch of spikes is ever held in memory. The layout (binary store or
+    JSON) follows the file extension, as in `write_data`.
+
+        with DataWriter('data.npz', metadata) as writer:
+            writer.add('spikes', table)
+    """
+
+    def __init__(self, file, metadata):
+        self.file = file
+        self.metadata = metadata
+        self._binary = file.lower().endswith('.npz')
+        self._tables = {}
+        self._dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(file)))
+
+    def add(self, name, table):
+        """Append the neuroids of packed spike `table` to spike table `name` ('spikes' or 'baseline/spikes')."""
+        if name not in self._tables:
+            self._tables[name] = {'neuroid': [], 'item': table['item'], 'trial': table['trial'], 'offsets': [[0]],
+                                  'n_times': 0, 'spool': open(os.path.join(self._dir, name.replace('/', '.')), 'wb')}
+        state = self._tables[name]
+        assert (state['item'] == table['item']).all() and (state['trial'] == table['trial']).all()
+
+        if self._binary:
+            asarray(table['times'], dtype=float64).tofile(state['spool'])
+            state['offsets'].append(asarray(table['offsets'][1:]) + state['n_times'])
+            state['n_times'] += len(table['times'])
+        else:
+            for neuroid, spikes in unpack_spikes(table).items():
+                state['spool'].write(((', ' if state['neuroid'] else '') + json.dumps(neuroid) + ': ' +
+                                      json.dumps(spikes)).encode())
+        state['neuroid'].extend(table['neuroid'].tolist())
+
+    def close(self):
+        """Put the data file together from the metadata and the spooled spike tables."""
+        try:
+            for state in self._tables.values():
+                state['spool'].close()
+            if self._binary:
+                self._write_binary()
+            else:
+                self._write_json()
+        finally:
+            self._discard()
+
+    def _write_binary(self):
+        arrays = {}
+        for name, state in self._tables.items():
+            spool = os.path.join(self._dir, name.replace('/', '.'))
+            times = memmap(spool, dtype=float64, mode='r') if state['n_times'] else empty(0)
+            table = make_table(state['neuroid'], state['item'], state['trial'], times, concatenate(state['offsets']))
+            for key, column in table.items():
+                arrays[name + '/' + key] = column
+        metadata = _map_tables(self.metadata, lambda _: None)
+        arrays['metadata'] = frombuffer(json.dumps(metadata).encode(), dtype=uint8)
+        # Times are copied over from the spool files a chunk at a time.
+        savez(self.file, **arrays)
+        del arrays
+
+    def _write_json(self):
+        # Dump the metadata with a placeholder for each spike table, then stream the spooled tables in their place.
+        metadata = json.loads(json.dumps(_map_tables(self.metadata, lambda _: None)))
+        for name in self._tables:
+            _set(metadata, tuple(name.split('/')), '@@' + name + '@@')
+        parts = re.split('"@@(.+?)@@"', json.dumps(metadata, indent=4))
+        with open(self.file, 'w') as f:
+            for i, part in enumerate(parts):
+                if i % 2 == 0:
+                    f.write(part)
+                    continue
+                f.write('{')
+                with open(os.path.join(self._dir, part.replace('/', '.'))) as spool:
+                    shutil.copyfileobj(spool, f)
+                f.write('}')
+
+    def _discard(self):
+        for state in self._tables.values():
+            state['spool'].close()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._discard()
+
+
+def _memmap_member(file, name):
+    """Memory-map the array stored as `name` in the (uncompressed) .npz `file`."""
+    with zipfile.ZipFile(file) as z:
+        info = z.getinfo(name + '.npy')
+    assert info.compress_type == zipfile.ZIP_STORED
+
+    with open(file, 'rb') as f:
+        # Skip the zip local file header (whose name and extra field lengths can differ from the central directory).
+        f.seek(info.header_offset)
+        name_length, extra_length = struct.unpack('<HH', f.read(30)[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = npy_format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = npy_format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = npy_format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    if 0 in shape:
+        return empty(shape, dtype=dtype)
+    return memmap(file, dtype=dtype, mode='r', shape=shape, order='F' if fortran_order else 'C', offset=offset)
+
+
+# Scalar parameters stored in the header of a binary parameters file (see `write_parameters`).
+PARAMETERS_HEADER = ['f_sampling', 'n_channels', 'n_trials', 'threshold_sd', 'chunks_for_threshold', 'f_low', 'f_high',
+                     'ellip_order', 'start_time', 'stop_time']
+
+
+def write_parameters(file, parameters, trial_onsets, baseline_onsets, json_stat):
+    """Write what spike detection needs from a session's `parameters` to a binary parameters file (.npz).
+
+    The scalars go in a one-record `header`, and the trial onsets of the items and baseline items as dense
+    float64 (item, trial) arrays. Arrays are stored uncompressed, so `read_parameters` can memory-map them.
+    `json_stat` is the (size, mtime_ns) of the JSON parameters file written along with it.
+    """
+    header = array(tuple(parameters[key] for key in PARAMETERS_HEADER),
+                   dtype=[(key, int64 if isinstance(parameters[key], int) else float64) for key in PARAMETERS_HEADER])
+    neuroid_id = parameters['neuroid']['neuroid_id']
+    savez(file, header=header, channel=array(list(neuroid_id.keys()), dtype=str),
+          neuroid_id=array(list(neuroid_id.values()), dtype=str),
+          item=array([str(_) for _ in parameters['item']['id'].values()], dtype=str),
+          trial_onsets=asarray(trial_onsets, dtype=float64),
+          baseline_item=array(list(parameters['baseline']['trial_times'].keys()), dtype=str),
+          baseline_onsets=asarray(baseline_onsets, dtype=float64), json_stat=array(json_stat, dtype=int64))
+
+
+def read_parameters(file):
+    """Read a binary parameters file written by `write_parameters`.
+
+    Returns the header scalars, along with `neuroid_id` (a channel -> neuroid id dictionary), the `item` and
+    `baseline_item` labels, the memory-mapped `trial_onsets` and `baseline_onsets`, and `json_stat`.
+    """
+    assert os.path.isfile(file)
+    with load(file) as arrays:
+        header = arrays['header']
+        parameters = {key: header[key].item() for key in header.dtype.names}
+        parameters['neuroid_id'] = dict(zip(arrays['channel'].tolist(), arrays['neuroid_id'].tolist()))
+        parameters['item'] = arrays['item'].tolist()
+        parameters['baseline_item'] = arrays['baseline_item'].tolist()
+        parameters['json_stat'] = tuple(arrays['json_stat'].tolist())
+    parameters['trial_onsets'] = _memmap_member(file, 'trial_onsets')
+    parameters['baseline_onsets'] = _memmap_member(file, 'baseline_onsets')
+    return parameters
+
+
+class SessionData(object):
+    """Handle on a data file that loads spikes only when they are asked for.
+
+    Metadata (everything but the spike tables) and the (neuroid, item, trial) labels
+    of each spike table are parsed up front. For the binary store, spike times and
+    offsets are memory-mapped, so only the spikes of the neuroids (or items) that are
+    accessed are ever read. JSON files have no such index, and are loaded in full.
+
+    Spike tables are named by their path in the data file: 'spikes' and 'baseline/spikes'.
+    """
+
+    def __init__(self, file):
+        assert os.path.isfile(file)
+        self.file = file
+        self._tables = {}
+        if file.lower().endswith('.npz'):
+            with load(file) as arrays:
+                self.metadata = json.loads(arrays['metadata'].tobytes().decode())
+                for path in SPIKE_TABLES:
+                    name = '/'.join(path)
+                    if name + '/offsets' in arrays.files:
+                        self._tables[name] = {key: arrays[name + '/' + key] for key in ['neuroid', 'item', 'trial']}
+            for name, table in self._tables.items():
+                table['times'] = _memmap_member(file, name + '/times')
+                table['offsets'] = _memmap_member(file, name + '/offsets')
+        else:
+            data = read_data(file, packed=True)
+            for path in SPIKE_TABLES:
+                if _get(data, path) is not None:
+                    self._tables['/'.join(path)] = _get(data, path)
+            self.metadata = _map_tables(data, lambda _: None)
+
+    @property
+    def tables(self):
+        """Names of the spike tables in the file."""
+        return list(self._tables)
+
+    def neuroids(self, table='spikes'):
+        return self._tables[table]['neuroid'].tolist()
+
+    def items(self, table='spikes'):
+        return self._tables[table]['item'].tolist()
+
+    def trials(self, table='spikes'):
+        return self._tables[table]['trial'].tolist()
+
+    def table(self, table='spikes', neuroids=None, trials=None):
+        """Packed spike table, restricted to the given neuroids and (start, stop) range of trials (by position).
+
+        All neuroids and trials are kept by default.
+        """
+        if trials is not None:
+            return select_neuroids(select_trials(self._tables[table], *trials), neuroids)
+        return select_neuroids(self._tables[table], neuroids)
+
+    def spikes(self, neuroid, item=None, table='spikes'):
+        """Nested spikes of one neuroid: {item: {trial: spike times}}, or {trial: spike times} for one item."""
+        spikes = unpack_spikes(self.table(table, [neuroid]))[neuroid]
+        return spikes if item is None else spikes[str(item)]
+
+    def sessions(self):
+        """Records (see `session_record`) of the sessions the file is made of, in trial order.
+
+        Files that do not list their sessions are taken to be a single session.
+        """
+        if 'sessions' in self.metadata:
+            return self.metadata['sessions']
+        return [session_record(os.path.basename(self.file).split('_data')[0], self._tables['spikes'],
+                               self._tables['baseline/spikes'])]
+
+    def read(self, packed=False):
+        """Load the whole file, as `read_data` would."""
+        data = json.loads(json.dumps(self.metadata))
+        for path in SPIKE_TABLES:
+            name = '/'.join(path)
+            if name in self._tables:
+                table = self.table(name)
+                _set(data, path, table if packed else unpack_spikes(table))
+        return data
+
+
+if __name__ == '__main__':
+    # Convert between the binary and JSON layouts, e.g. to export a .npz data file to JSON.
+    assert len(sys.argv) == 3
+    write_data(sys.argv[2], read_data(sys.argv[1], packed=True))
@@ -2,11 +2,204 @@ import argparse
 import configparser
 import os
 import json
-from utilities import natural_sorting, apply_bandpass, read_dat
-from numpy import ceil, arange, nanmean, median, abs, array, concatenate, diff, nonzero
-
-
-def main(project_dir, date, channel):
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utilities import natural_sorting, memmap_channel, iter_bandpass, load_filter_designs, trial_onsets, \
+    window_spikes, resolve_metadata, share_arrays, attach_arrays, FILTER_DESIGNS_FILE, METADATA_DIR
+from spike_store import make_table, write_data, read_parameters
+from numpy import ceil, nanmean, median, abs, array, concatenate, diff, nonzero
+
+# Parameters (from the parameters file) needed for spike detection.
+_SETTINGS = ['f_sampling', 'f_low', 'f_high', 'ellip_order', 'threshold_sd', 'chunks_for_threshold',
+             'start_time', 'stop_time', 'n_trials']
+
+
+def _segments(blocks, n_per_segment):
+    """Regroup consecutive (offset, block) pairs into (offset, segment) pairs of n_per_segment samples."""
+    pieces, start, size = [], 0, 0
+    for _, block in blocks:
+        pieces.append(block)
+        size += block.shape[-1]
+        while size >= n_per_segment:
+            segment = concatenate(pieces, axis=-1)
+            yield start, segment[..., :n_per_segment]
+            pieces = [segment[..., n_per_segment:]]
+            start += n_per_segment
+            size -= n_per_segment
+    if size:
+        yield start, concatenate(pieces, axis=-1)
+
+
+def _detect(v, parameters):
+    """Detect threshold crossings on all channels in `v` at once.
+
+    Returns a list of spike times (in seconds), one per channel.
+    """
+    nrSegments = parameters['chunks_for_threshold']
+    nrPerSegment = int(ceil(len(v[0]) / nrSegments))
+    spike_times = [[] for _ in v]
+
+    # Apply IIR Filter. The recording is filtered as one continuous stream, a block at a time, and regrouped
+    # into segments so the threshold is still computed per segment. Channels are stacked along the first axis.
+    blocks = iter_bandpass(v, parameters['f_sampling'], parameters['f_low'], parameters['f_high'],
+                           parameters['ellip_order'])
+
+    # TODO: Detect for both positive and negative thresholds?
+    for start, v1 in _segments(blocks, nrPerSegment):
+        v2 = v1 - nanmean(v1, axis=-1, keepdims=True)
+
+        # Apply threshold.
+        noise_level = -parameters['threshold_sd'] * median(abs(v2), axis=-1, keepdims=True) / 0.6745
+        outside = array(v2) < noise_level  # Spits a logical array
+
+        outside = outside.astype(int)  # Convert logical array to int array for diff to work
+
+        cross = concatenate((outside[:, :1], diff(outside, n=1, axis=-1) > 0), axis=-1)
+
+        ch_idxs, idxs = nonzero(cross)
+        for i in range(len(v)):
+            spike_times[i].extend((start + idxs[ch_idxs == i]) / parameters['f_sampling'])  # in seconds
+
+    return spike_times
+
+
+def _align(spike_times, session, neuroid_id):
+    """Cut spike times up into trials, aligned to stimulus onset, as packed spike tables."""
+    settings = session['settings']
+    trials = [str(trial + 1) for trial in range(settings['n_trials'])]
+
+    # Window all (item, trial) pairs at once.
+    times, offsets = window_spikes(spike_times, session['onsets'], settings['start_time'], settings['stop_time'])
+    spikes = make_table([neuroid_id], session['items'], trials, times, offsets)
+    times, offsets = window_spikes(spike_times, session['baseline_onsets'], settings['start_time'],
+                                   settings['stop_time'])
+    baseline = make_table([neuroid_id], session['baseline_items'], trials, times, offsets)
+
+    return {'spikes': spikes, 'baseline': {'spikes': baseline}}
+
+
+def _load_session(project_dir, d):
+    """Load what spike detection needs from the parameters file of session `d`.
+
+    Only the scalar settings and neuroid ids are kept from the parameters; trial
+    times are gathered into dense (item, trial) arrays of onsets. The binary
+    parameters file is preferred, as its onsets are memory-mapped rather than parsed.
+    """
+    if os.path.isfile(os.path.join(project_dir, 'proc', d + '_parameters.npz')):
+        parameters = read_parameters(os.path.join(project_dir, 'proc', d + '_parameters.npz'))
+        # Check that both parameters files come from the same merge run.
+        stat = os.stat(os.path.join(project_dir, 'proc', d + '_parameters.json'))
+        assert parameters['json_stat'] == (stat.st_size, stat.st_mtime_ns), \
+            'Binary parameters of %s do not match its JSON parameters; run merge.py again' % d
+        session = {}
+        session['settings'] = {key: parameters[key] for key in _SETTINGS}
+        session['neuroid_id'] = parameters['neuroid_id']
+        session['items'] = parameters['item']
+        session['onsets'] = parameters['trial_onsets']
+        session['baseline_items'] = parameters['baseline_item']
+        session['baseline_onsets'] = parameters['baseline_onsets']
+        return session
+
+    # Check if the parameters file---where all data is going to be stored---exists.
+    # TODO: Change this to a braintree location
+    assert os.path.isfile(os.path.join(project_dir, 'proc', d + '_parameters.json'))
+
+    with open(os.path.join(project_dir, 'proc', d + '_parameters.json')) as f:
+        parameters = json.load(f)
+    resolve_metadata(parameters, os.path.join(project_dir, 'proc', METADATA_DIR))
+
+    session = {}
+    session['settings'] = {key: parameters[key] for key in _SETTINGS}
+    session['neuroid_id'] = parameters['neuroid']['neuroid_id']
+    session['items'] = [str(_) for _ in parameters['item']['id'].values()]
+    session['onsets'] = trial_onsets(parameters['trial_times'], session['items'], parameters['n_trials'])
+    session['baseline_items'] = [str(_) for _ in parameters['baseline']['trial_times'].keys()]
+    session['baseline_onsets'] = trial_onsets(parameters['baseline']['trial_times'], session['baseline_items'],
+                                              parameters['n_trials'])
+    return session
+
+
+def _detect_and_store(project_dir, d, session, channels):
+    """Detect spikes on `channels` of session `d`, and store them in the temp directory."""
+    neuroid_ids = [session['neuroid_id'][channel] for channel in channels]
+
+    # Memory-map raw data (amp-*.dat files, or the data blocks of a single .rhd file), so that only one segment at a
+    # time is read (and converted to microvolts).
+    v = [memmap_channel(os.path.join(project_dir, 'intanraw', d), neuroid_id) for neuroid_id in neuroid_ids]
+    assert all(len(_) == len(v[0]) for _ in v)
+
+    spike_times = _detect(v, session['settings'])
+
+    # Make temp directory if it does not exist.
+    os.makedirs(os.path.join(project_dir, 'temp'), exist_ok=True)
+
+    # Make experiment directory inside temp if it does not exist.
+    os.makedirs(os.path.join(project_dir, 'temp', d), exist_ok=True)
+
+    for channel, neuroid_id, channel_spike_times in zip(channels, neuroid_ids, spike_times):
+        spk_data = _align(channel_spike_times, session, neuroid_id)
+        write_data(os.path.join(project_dir, 'temp', d, 'spk_' + channel + '.npz'), spk_data)
+
+
+def _share_onsets(session):
+    """Move the trial onsets of `session` into shared memory (see `share_arrays`)."""
+    shms, arrays = share_arrays({key: session[key] for key in ['onsets', 'baseline_onsets']})
+    shared = {'session': {key: value for key, value in session.items() if key not in arrays}, 'arrays': arrays}
+    return shms, shared
+
+
+def _task(project_dir, d, shared, channel):
+    """Run spike detection for a single (session directory, channel) work unit in a worker process."""
+    with attach_arrays(shared['arrays']) as arrays:
+        session = dict(shared['session'], **arrays)
+        _detect_and_store(project_dir, d, session, [channel])
+        del session
+
+
+def _run_parallel(project_dir, dirs, channels, workers):
+    """Spread (session directory, channel) work units over a pool of `workers` processes."""
+    shms, failures = [], {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=load_filter_designs,
+                                 initargs=(os.path.join(project_dir, 'proc', FILTER_DESIGNS_FILE),)) as executor:
+            futures = {}
+            for d in dirs:
+                session_shms, shared = _share_onsets(_load_session(project_dir, d))
+                shms.extend(session_shms)
+                for channel in channels:
+                    futures[executor.submit(_task, project_dir, d, shared, channel)] = (d, channel)
+
+            for i, future in enumerate(as_completed(futures)):
+                d, channel = futures[future]
+                try:
+                    future.result()
+                    print('[%d/%d] %s channel %s done' % (i + 1, len(futures), d, channel))
+                except Exception as e:
+                    failures[(d, channel)] = e
+                    print('[%d/%d] %s channel %s failed: %r' % (i + 1, len(futures), d, channel, e))
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    if failures:
+        raise Exception('Spike detection failed for %d of %d tasks: %s' % (
+            len(failures), len(dirs) * len(channels),
+            ', '.join('%s channel %s' % _ for _ in sorted(failures, key=lambda _: (_[0], int(_[1]))))))
+
+
+def _parse_channels(text):
+    """Parse a channel number (5), an inclusive range (0-95), or a comma-separated list of those (0-3,8,10)."""
+    channels = []
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            channels.extend(range(int(first), int(last) + 1))
+        else:
+            channels.append(int(part))
+    return [str(_) for _ in channels]
+
+
+def main(project_dir, date, channels, workers=1):
     # TODO: Maybe add checks to ensure params.json and config.ini information match?
 
     # Get names of all directories with the specified 'date'.
@@ -14,101 +207,27 @@ def main(project_dir, date, channel):
         dirs = [entry.name for entry in it if (entry.is_dir() and entry.name.find(date) is not -1)]
     dirs.sort(key=natural_sorting)
 
-    # Loop through each directory, and detect spikes.
+    if workers > 1:
+        _run_parallel(project_dir, dirs, channels, workers)
+        return
+
+    # Pick up the filter designs precomputed by merge.py.
+    load_filter_designs(os.path.join(project_dir, 'proc', FILTER_DESIGNS_FILE))
+
+    # Loop through each directory, and detect spikes. Parameters are loaded once and shared by all channels.
     for d in dirs:
-        # Check if the parameters file---where all data is going to be stored---exists.
-        # TODO: Change this to a braintree location
-        assert os.path.isfile(os.path.join(project_dir, 'proc', d + '_parameters.json'))
-
-        with open(os.path.join(project_dir, 'proc', d + '_parameters.json')) as f:
-            parameters = json.load(f)
-
-        # TODO: Unnecessary check since merge.py already kinda does this?
-        assert os.path.isfile(os.path.join(project_dir, 'intanraw', d, 'amp-' +
-                                           parameters['neuroid']['neuroid_id'][channel] + '.dat'))
-
-        # Read raw data.
-        v = read_dat(os.path.join(project_dir, 'intanraw', d, 'amp-' +
-                                  parameters['neuroid']['neuroid_id'][channel] + '.dat'))
-
-        nrSegments = parameters['chunks_for_threshold']
-        nrPerSegment = int(ceil(len(v) / nrSegments))
-        spike_times = []
-
-        # TODO: Detect for both positive and negative thresholds?
-        for i in range(nrSegments):
-            time_idxs = arange(i * nrPerSegment, (i + 1) * nrPerSegment) / parameters['f_sampling']  # in seconds
-
-            # Apply IIR Filter.
-            v1 = apply_bandpass(v[i * nrPerSegment:(i + 1) * nrPerSegment], parameters['f_sampling'],
-                                parameters['f_low'], parameters['f_high'], parameters['ellip_order'])
-            v2 = v1 - nanmean(v1)
-
-            # Apply threshold.
-            noise_level = -parameters['threshold_sd'] * median(abs(v2)) / 0.6745
-            outside = array(v2) < noise_level  # Spits a logical array
-
-            outside = outside.astype(int)  # Convert logical array to int array for diff to work
-
-            cross = concatenate(([outside[0]], diff(outside, n=1) > 0))
-
-            idxs = nonzero(cross)[0]
-            spike_times.extend(time_idxs[idxs])
-
-        # Create placeholders for spikes and baseline data.
-        spk_data = {}
-        spk_data['spikes'] = {}
-        spk_data['spikes'][parameters['neuroid']['neuroid_id'][channel]] = {}
-        spk_data['baseline'] = {}
-        spk_data['baseline'][parameters['neuroid']['neuroid_id'][channel]] = {}
-
-        # spk_data = {
-        #     parameters['neuroid']['neuroid_id'][channel]: {}
-        # }
-        # Loop through each image.
-        for i, item in parameters['item']['id'].items():
-            spk_data['spikes'][parameters['neuroid']['neuroid_id'][channel]][str(item)] = {}
-            # Loop through each trial.
-            for trial in range(parameters['n_trials']):
-                spikes = list(filter(lambda x: x >= parameters['trial_times'][str(item)][str(trial+1)] -
-                                     parameters['start_time'], spike_times))  # TODO: Add check for +- sign
-                spikes = list(filter(lambda x: x <= parameters['trial_times'][str(item)][str(trial+1)] +
-                                     parameters['stop_time'], spikes))  # TODO: Better way to do this
-                # Align spikes to stimulus onset (SO)
-                spikes = [_ - parameters['trial_times'][str(item)][str(trial+1)] for _ in spikes]
-                spk_data['spikes'][parameters['neuroid']['neuroid_id'][channel]][str(item)][str(trial+1)] = spikes
-
-        # Loop through each baseline image.
-        for baseline_image in parameters['baseline']['trial_times'].keys():
-            spk_data['baseline'][parameters['neuroid']['neuroid_id'][channel]][str(baseline_image)] = {}
-            # Loop through each trial.
-            for trial in range(parameters['n_trials']):
-                spikes = list(filter(lambda x: x >= parameters['baseline']['trial_times'][str(baseline_image)][str(trial + 1)] -
-                                               parameters['start_time'], spike_times))  # TODO: Add check for +- sign
-                spikes = list(filter(lambda x: x <= parameters['baseline']['trial_times'][str(baseline_image)][str(trial + 1)] +
-                                               parameters['stop_time'], spikes))  # TODO: Better way to do this
-                # Align spikes to stimulus onset (SO)
-                spikes = [_ - parameters['baseline']['trial_times'][str(baseline_image)][str(trial + 1)] for _ in spikes]
-                spk_data['baseline'][parameters['neuroid']['neuroid_id'][channel]][str(baseline_image)][str(trial + 1)] = spikes
-
-        # Make temp directory if it does not exist.
-        if not os.path.isdir(os.path.join(project_dir, 'temp')):
-            os.mkdir(os.path.join(project_dir, 'temp'))
-
-        # Make experiment directory inside temp if it does not exist.
-        if not os.path.isdir(os.path.join(project_dir, 'temp', d)):
-            os.mkdir(os.path.join(project_dir, 'temp', d))
-
-        with open(os.path.join(project_dir, 'temp', d, 'spk_' + channel + '.json'), 'w') as f:
-            json.dump(spk_data, f, indent=4)
+        _detect_and_store(project_dir, d, _load_session(project_dir, d), channels)
 
     return
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Multi-unit activity analysis tools.')
-    parser.add_argument('num', metavar='N', type=int,
-                        help='channel number or slurm job array id')
+    parser.add_argument('num', metavar='N', type=str,
+                        help='channel number or slurm job array id; also accepts a range (0-95) or a '
+                             'comma-separated list (0-3,8,10) of channels to process in one go')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes to spread (session directory, channel) work units over')
     # TODO: Think of a better way to get access to this information than re-reading config
     parser.add_argument('--config', type=str, help='full path and name of the .ini file '
                                                    'defining the experiment parameters')
@@ -128,4 +247,4 @@ if __name__ == '__main__':
     date = date[0][-2:] + date[1] + date[2]
     project_dir = config['File IO']['project_dir']
 
-    main(project_dir, date, str(args.num))
+    main(project_dir, date, _parse_channels(args.num), args.workers)
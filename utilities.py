@@ -1,10 +1,37 @@
 import re
 import os
-import sys
 import struct
 import json
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import shared_memory
 from scipy import signal
-from numpy import fromfile
+from numpy import fromfile, memmap, stack, concatenate, ceil, log, array, empty, asarray, searchsorted, arange, \
+    repeat, cumsum, diff, bincount, frombuffer, dtype, nonzero, argsort, less, greater, not_equal, int64, \
+    ndarray
+
+# Intan amplifier resolution, in microvolts per bit.
+MICROVOLTS_PER_BIT = 0.195
+
+# Name of the file (in the proc directory) where merge.py stores the filter designs used in an experiment.
+FILTER_DESIGNS_FILE = 'filter_designs.json'
+
+# Passband ripple and stopband attenuation (in dB) of the band-pass filter.
+FILTER_RIPPLE = 0.1
+FILTER_ATTENUATION = 40
+
+# Filter designs computed (or loaded) so far, keyed on _filter_key.
+_filter_designs = {}
+
+# Name of the directory (in the proc directory) where merge.py stores the experiment metadata, one file per blob.
+METADATA_DIR = 'metadata'
+
+# Parameters that merge.py stores in the metadata directory, and refers to by hash.
+METADATA_KEYS = ('item', 'neuroid')
+
+# Metadata blobs loaded so far, keyed on their hash.
+_metadata = {}
 
 
 def _convert(text):
@@ -25,87 +52,389 @@ def read_dat(filename):
     v = fromfile(fid, 'int16', num_samples)
     fid.close()
 
-    v = v * 0.195  # convert to microvolts
+    v = v * MICROVOLTS_PER_BIT  # convert to microvolts
     return v
 
 
-def apply_bandpass(data, f_sampling, f_low, f_high, ellip_order):
-    wl = f_low / (f_sampling / 2.)
-    wh = f_high / (f_sampling / 2.)
-    wn = [wl, wh]
-
-    # Designs a ellip_order-order Elliptic band-pass filter which passes
-    # frequencies between 0.03 and 0.6, and with 0.1 dB of ripple in the
-    # passband, and 40 dB of attenuation in the stopband.
-    b, a = signal.ellip(ellip_order, 0.1, 40, wn, 'bandpass', analog=False)
-    # To match Matlab output, we change default padlen from
-    # 3*(max(len(a), len(b))) to 3*(max(len(a), len(b)) - 1)
-    return signal.filtfilt(b, a, data, padlen=3 * (max(len(a), len(b)) - 1))
+def memmap_dat(filename, sample_type='int16'):
+    """Memory-map an Intan .dat file of the one-file-per-channel layout.
 
+    Returns a read-only view over the file (int16 for amplifier files, amp-*.dat;
+    board-*.dat digital inputs are 'uint16'), so nothing is read from disk (or
+    scaled) until it is accessed. Use `memmap_channel` to map a channel of either
+    recording layout, and `read_microvolts` or `iter_microvolts` to get amplifier
+    samples in microvolts one chunk at a time.
+    """
+    return memmap(filename, dtype=sample_type, mode='r')
 
-def _read_qstring(fid):
-    """Read Qt style QString.
 
-    The first 32-bit unsigned number indicates the length of the string (in bytes).
-    If this number equals 0xFFFFFFFF, the string is null.
+def read_microvolts(v, start=0, stop=None):
+    """Return samples start:stop of raw amplifier data `v` in microvolts.
 
-    Strings are stored as unicode.
+    `v` is either a single channel (e.g. as returned by `memmap_channel`, for an
+    amp-*.dat file or a single .rhd file) or a list of channels of equal length,
+    in which case they are stacked along the first axis. Only the requested
+    samples are copied into memory.
+    """
+    if isinstance(v, (list, tuple)):
+        return stack([_[start:stop] for _ in v]) * MICROVOLTS_PER_BIT
+    return v[start:stop] * MICROVOLTS_PER_BIT
 
-    Michael Gibson 23 April 2015.
+
+def iter_microvolts(v, chunk_size=2 ** 20, start=0, stop=None):
+    """Walk through raw amplifier data `v`, yielding (offset, chunk) pairs.
+
+    Each chunk holds at most `chunk_size` samples (along the last axis),
+    converted to microvolts, and `offset` is the index of its first sample.
+    """
+    n = len(v[0]) if isinstance(v, (list, tuple)) else len(v)
+    stop = n if stop is None else min(stop, n)
+    for offset in range(start, stop, chunk_size):
+        yield offset, read_microvolts(v, offset, min(offset + chunk_size, stop))
+
+
+def _filter_key(f_sampling, f_low, f_high, ellip_order):
+    # Every argument of the design is part of the key, so designs stored with other settings are never picked up.
+    return '%r_%r_%r_%d_%r_%r' % (float(f_sampling), float(f_low), float(f_high), ellip_order, float(FILTER_RIPPLE),
+                                  float(FILTER_ATTENUATION))
+
+
+def design_bandpass(f_sampling, f_low, f_high, ellip_order, output='ba'):
+    """Design (or look up) the band-pass filter for the given settings.
+
+    Designs are cached, so the filter is only designed once per process for each
+    set of parameters; `load_filter_designs` also fills the cache from disk.
     """
-    length, = struct.unpack('<I', fid.read(4))
-    if length == int('ffffffff', 16): return ""
+    key = _filter_key(f_sampling, f_low, f_high, ellip_order)
+    if key not in _filter_designs:
+        wl = f_low / (f_sampling / 2.)
+        wh = f_high / (f_sampling / 2.)
+        wn = [wl, wh]
+
+        # Designs a ellip_order-order Elliptic band-pass filter which passes
+        # frequencies between 0.03 and 0.6, and with 0.1 dB of ripple in the
+        # passband, and 40 dB of attenuation in the stopband.
+        b, a = signal.ellip(ellip_order, FILTER_RIPPLE, FILTER_ATTENUATION, wn, 'bandpass', analog=False)
+        sos = signal.ellip(ellip_order, FILTER_RIPPLE, FILTER_ATTENUATION, wn, 'bandpass', analog=False, output='sos')
+        _filter_designs[key] = {'ba': (b, a), 'sos': sos}
+    return _filter_designs[key][output]
+
+
+def load_filter_designs(file):
+    """Add the filter designs stored in `file` (if it exists) to the cache."""
+    if not os.path.isfile(file):
+        return
+    with open(file) as f:
+        designs = json.load(f)
+    for key, design in designs.items():
+        _filter_designs[key] = {'ba': (array(design['b']), array(design['a'])), 'sos': array(design['sos'])}
+
+
+def store_filter_designs(file, f_sampling, f_low, f_high, ellip_order):
+    """Add the design for the given filter settings to the designs stored in `file`."""
+    designs = {}
+    if os.path.isfile(file):
+        with open(file) as f:
+            designs = json.load(f)
+    key = _filter_key(f_sampling, f_low, f_high, ellip_order)
+    if key in designs:
+        return
+    b, a = design_bandpass(f_sampling, f_low, f_high, ellip_order)
+    sos = design_bandpass(f_sampling, f_low, f_high, ellip_order, output='sos')
+    designs[key] = {'b': b.tolist(), 'a': a.tolist(), 'sos': sos.tolist()}
+    # Spike detection jobs may be reading the file (e.g. when merge.py is re-run), so it is replaced in one go.
+    with atomic_open(file, 'w') as f:
+        json.dump(designs, f, indent=4)
+
 
-    if length > (os.fstat(fid.fileno()).st_size - fid.tell() + 1):
-        print(length)
-        raise Exception('Length too long.')
+def apply_bandpass(data, f_sampling, f_low, f_high, ellip_order):
+    b, a = design_bandpass(f_sampling, f_low, f_high, ellip_order)
+    # To match Matlab output, we change default padlen from
+    # 3*(max(len(a), len(b))) to 3*(max(len(a), len(b)) - 1)
+    return signal.filtfilt(b, a, data, padlen=3 * (max(len(a), len(b)) - 1))
 
-    # convert length from bytes to 16-bit Unicode words
-    length = int(length / 2)
 
-    data = []
-    for i in range(0, length):
-        c, = struct.unpack('<H', fid.read(2))
-        data.append(c)
+def _settling_samples(sos, tol=1e-12):
+    """Number of samples after which the impulse response of `sos` has decayed below `tol`."""
+    _, p, _ = signal.sos2zpk(sos)
+    return int(ceil(log(tol) / log(abs(p).max())))
 
-    if sys.version_info >= (3, 0):
-        a = ''.join([chr(c) for c in data])
-    else:
-        a = ''.join([unichr(c) for c in data])
 
-    return a
+def _scaled_zi(zi, x0):
+    """Steady-state initial conditions `zi` (from sosfilt_zi) for a step of height `x0`."""
+    return zi.reshape((zi.shape[0],) + (1,) * x0.ndim + (2,)) * x0[..., None]
+
+
+def iter_bandpass(v, f_sampling, f_low, f_high, ellip_order, block_size=2 ** 16, overlap=None):
+    """Zero-phase band-pass filter raw amplifier data `v` (anything `read_microvolts` accepts) block by block.
+
+    Yields (offset, block) pairs of filtered data in microvolts, which put together match `apply_bandpass`.
+    Each block is filtered backwards along with the next `overlap` samples (by default, the settling time).
+    """
+    sos = design_bandpass(f_sampling, f_low, f_high, ellip_order, output='sos')
+    if overlap is None:
+        overlap = _settling_samples(sos)
+    zi = signal.sosfilt_zi(sos)
+
+    # Same (odd extension) padding as apply_bandpass, but only at either end of the recording.
+    padlen = 3 * 2 * len(sos)
+    n = len(v[0]) if isinstance(v, (list, tuple)) else len(v)
+    if n <= padlen:
+        raise ValueError('The length of the input vector must be greater than padlen, which is %d.' % padlen)
+    first = read_microvolts(v, 0, padlen + 1)
+    last = read_microvolts(v, n - padlen - 1, n)
+    left = 2 * first[..., :1] - first[..., padlen:0:-1]
+    right = 2 * last[..., -1:] - last[..., -2::-1]
+
+    def forward():
+        z = _scaled_zi(zi, left[..., 0])
+        y, z = signal.sosfilt(sos, left, zi=z)
+        yield y
+        for _, x in iter_microvolts(v, block_size):
+            y, z = signal.sosfilt(sos, x, zi=z)
+            yield y
+        y, z = signal.sosfilt(sos, right, zi=z)
+        yield y
+
+    def trim(start, y):
+        # Drop whatever falls in the padding.
+        lo, hi = max(0, -start), min(y.shape[-1], n - start)
+        return (start + lo, y[..., lo:hi]) if hi > lo else None
+
+    buf = None
+    start = -padlen  # Index (in the unpadded recording) of the first sample in buf.
+    for y in forward():
+        buf = y if buf is None else concatenate((buf, y), axis=-1)
+        while buf.shape[-1] >= block_size + overlap:
+            y = signal.sosfilt(sos, buf[..., block_size + overlap - 1::-1])[..., ::-1]
+            out = trim(start, y[..., :block_size])
+            if out is not None:
+                yield out
+            buf = buf[..., block_size:]
+            start += block_size
+
+    # The tail is filtered backwards in one go, starting from the same initial conditions as filtfilt.
+    y = signal.sosfilt(sos, buf[..., ::-1], zi=_scaled_zi(zi, buf[..., -1]))[0][..., ::-1]
+    out = trim(start, y)
+    if out is not None:
+        yield out
+
+
+# Fixed-size part of a channel record in an Intan header, which follows the channel's native and custom names.
+_RHD_CHANNEL_DTYPE = dtype([('native_order', '<i2'), ('custom_order', '<i2'), ('signal_type', '<i2'),
+                            ('channel_enabled', '<i2'), ('chip_channel', '<i2'), ('board_stream', '<i2'),
+                            ('voltage_trigger_mode', '<i2'), ('voltage_threshold', '<i2'),
+                            ('digital_trigger_channel', '<i2'), ('digital_edge_polarity', '<i2'),
+                            ('electrode_impedance_magnitude', '<f4'), ('electrode_impedance_phase', '<f4')])
+
+# Intan headers parsed so far, keyed on the path of the file, along with its (mtime, size).
+_rhd_headers = {}
+
+
+class _HeaderTruncated(Exception):
+    pass
+
+
+class _HeaderBuffer(object):
+    """Cursor over a memoryview of (the beginning of) an Intan file, which holds `limit` bytes from there on."""
+
+    def __init__(self, buf, limit):
+        self.buf = memoryview(buf)
+        self.limit = limit
+        self.pos = 0
+
+    def take(self, n):
+        """Skip `n` bytes, and return the offset they start at."""
+        if self.pos + n > len(self.buf):
+            raise _HeaderTruncated()
+        self.pos += n
+        return self.pos - n
+
+    def unpack(self, fmt):
+        return struct.unpack_from(fmt, self.buf, self.take(struct.calcsize(fmt)))
+
+    def qstring(self):
+        """Read Qt style QString.
+
+        The first 32-bit unsigned number indicates the length of the string (in bytes).
+        If this number equals 0xFFFFFFFF, the string is null.
+
+        Strings are stored as unicode (UTF-16LE).
+        """
+        length, = self.unpack('<I')
+        if length == int('ffffffff', 16): return ""
+
+        # Fail before reading (much) more of a corrupt file.
+        if length > self.limit - self.pos:
+            raise Exception('Length too long.')
+
+        start = self.take(length)
+        return bytes(self.buf[start:start + length]).decode('utf-16-le', errors='surrogatepass')
+
+    def record(self, record_dtype):
+        return frombuffer(self.buf, dtype=record_dtype, count=1, offset=self.take(record_dtype.itemsize))[0]
 
 
 def read_rhd(fid):
     """Reads the Intan File Format header from the given file.
 
+    The header is read into memory in one go (a larger piece is read if it turns out to be longer), and parsed
+    from there. The file is left positioned right after the header, whose size is stored in `header_size`.
+
     Michael Gibson 23 April 2015.
     Modified Adrian Foy Sep 2018.
     """
+    start, size = fid.tell(), 2 ** 16
+    limit = os.fstat(fid.fileno()).st_size - start
+    while True:
+        buf = fid.read(size)
+        try:
+            header = _parse_rhd(_HeaderBuffer(buf, limit))
+            break
+        except _HeaderTruncated:
+            if len(buf) < size:
+                raise Exception('Header is truncated.')
+            size *= 4
+            fid.seek(start)
+    fid.seek(start + header['header_size'])
+    return header
+
+
+def read_rhd_file(filename):
+    """Header of Intan file `filename` (see `read_rhd`).
+
+    Headers are parsed once per run, and reused for as long as the file is not modified. The returned header
+    is shared, so it should not be changed.
+    """
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    if filename not in _rhd_headers or _rhd_headers[filename][0] != (stat.st_mtime_ns, stat.st_size):
+        with open(filename, 'rb') as fid:
+            _rhd_headers[filename] = ((stat.st_mtime_ns, stat.st_size), read_rhd(fid))
+    return _rhd_headers[filename][1]
+
+
+def _rhd_block_dtype(header):
+    """Structured dtype of one data block of a traditional (single-file) Intan recording."""
+    n = header['num_samples_per_data_block']
+    fields = [('timestamps', '<i4', (n,)),
+              ('amplifier', '<u2', (header['num_amplifier_channels'], n)),
+              ('aux_input', '<u2', (header['num_aux_input_channels'], n // 4)),
+              ('supply_voltage', '<u2', (header['num_supply_voltage_channels'],)),
+              ('temp_sensor', '<i2', (header['num_temp_sensor_channels'],)),
+              ('board_adc', '<u2', (header['num_board_adc_channels'], n)),
+              ('board_dig_in', '<u2', (int(header['num_board_dig_in_channels'] > 0), n)),
+              ('board_dig_out', '<u2', (int(header['num_board_dig_out_channels'] > 0), n))]
+    # Signals without channels are not stored at all.
+    return dtype([_ for _ in fields if all(_[2])])
+
+
+class RHDSignal(object):
+    """One channel of a traditional (single-file) Intan recording, as a 1-D sequence of samples.
+
+    Samples are read through a zero-copy (block, sample) strided view into the memory-mapped data blocks, and
+    slicing only copies the blocks that are asked for. Amplifier channels give int16 samples, as in the
+    one-file-per-channel layout; digital inputs give 0/1 uint16 samples.
+    """
+
+    def __init__(self, blocks, bit=None):
+        self.blocks = blocks
+        self.bit = bit
+        self.dtype = dtype('uint16') if bit is not None else dtype('int16')
+        self.shape = (blocks.shape[0] * blocks.shape[1],)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1 or None][0]
+        start, stop, step = key.indices(len(self))
+        stop = max(start, stop)
+        first, n = start // self.blocks.shape[1], self.blocks.shape[1]
+        samples = asarray(self.blocks[first:-(-stop // n)]).reshape(-1)[start - first * n:stop - first * n:step]
+        if self.bit is not None:
+            return (samples >> self.bit) & 1
+        # Amplifier samples are stored offset by 32768; flipping the top bit makes them signed.
+        return (samples ^ 0x8000).view('int16')
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
 
+def memmap_rhd(filename):
+    """Memory-map a traditional (single-file) Intan recording: its header, followed by data blocks.
+
+    Returns (header, signals), where signals maps the native names of amplifier channels (e.g. 'A-000') and
+    digital inputs (e.g. 'DIGITAL-IN-02') to `RHDSignal` views. Nothing is read until samples are accessed.
+    """
+    header = read_rhd_file(filename)
+    block_dtype = _rhd_block_dtype(header)
+    n_bytes = os.path.getsize(filename) - header['header_size']
+    if n_bytes % block_dtype.itemsize != 0:
+        raise Exception('Something is wrong with file size : should have a whole number of data blocks.')
+    blocks = memmap(filename, dtype=block_dtype, mode='r', offset=header['header_size'],
+                    shape=(n_bytes // block_dtype.itemsize,))
+
+    signals = {}
+    for i, channel in enumerate(header['amplifier_channels']):
+        signals[channel['native_channel_name']] = RHDSignal(blocks['amplifier'][:, i, :])
+    for channel in header['board_dig_in_channels']:
+        signals[channel['native_channel_name']] = RHDSignal(blocks['board_dig_in'][:, 0, :], channel['native_order'])
+    return header, signals
+
+
+def intan_header_file(directory):
+    """Intan header file of a recording: info.rhd for the one-file-per-channel layout, or the .rhd file."""
+    if os.path.isfile(os.path.join(directory, 'info.rhd')):
+        return os.path.join(directory, 'info.rhd')
+    files = [_ for _ in os.listdir(directory) if _.lower().endswith('.rhd')]
+    assert len(files) == 1, 'Expected info.rhd or a single .rhd file in ' + directory
+    return os.path.join(directory, files[0])
+
+
+def memmap_channel(directory, name):
+    """Memory-map channel `name` (e.g. 'A-000' or 'DIGITAL-IN-02') of the Intan recording in `directory`.
+
+    Recordings can use either layout: one file per channel (amp-A-000.dat, board-DIGITAL-IN-02.dat) or a single
+    .rhd file. Either way, amplifier channels come as int16 and digital inputs as uint16 samples.
+    """
+    for prefix, sample_type in [('amp-', 'int16'), ('board-', 'uint16')]:
+        if os.path.isfile(os.path.join(directory, prefix + name + '.dat')):
+            return memmap_dat(os.path.join(directory, prefix + name + '.dat'), sample_type)
+    # Header files of the one-file-per-channel layout have no data blocks.
+    header_file = intan_header_file(directory)
+    assert os.path.getsize(header_file) > read_rhd_file(header_file)['header_size'], \
+        'Channel %s not found in %s' % (name, directory)
+    header, signals = memmap_rhd(header_file)
+    assert name in signals, 'Channel %s not found in %s' % (name, directory)
+    return signals[name]
+
+
+def _parse_rhd(reader):
     # Check 'magic number' at beginning of file to make sure this is an Intan
     # Technologies RHD2000 data file.
-    magic_number, = struct.unpack('<I', fid.read(4))
+    magic_number, = reader.unpack('<I')
     if magic_number != int('c6912702', 16): raise Exception('Unrecognized file type.')
 
     header = {}
     # Read version number.
     version = {}
-    (version['major'], version['minor']) = struct.unpack('<hh', fid.read(4))
+    (version['major'], version['minor']) = reader.unpack('<hh')
     header['version'] = version
 
     freq = {}
 
     # Read information of sampling rate and amplifier frequency settings.
-    header['sample_rate'], = struct.unpack('<f', fid.read(4))
+    header['sample_rate'], = reader.unpack('<f')
     (freq['dsp_enabled'], freq['actual_dsp_cutoff_frequency'], freq['actual_lower_bandwidth'],
      freq['actual_upper_bandwidth'],
      freq['desired_dsp_cutoff_frequency'], freq['desired_lower_bandwidth'],
-     freq['desired_upper_bandwidth']) = struct.unpack('<hffffff', fid.read(26))
+     freq['desired_upper_bandwidth']) = reader.unpack('<hffffff')
 
     # This tells us if a software 50/60 Hz notch filter was enabled during
     # the data acquisition.
-    notch_filter_mode, = struct.unpack('<h', fid.read(2))
+    notch_filter_mode, = reader.unpack('<h')
     header['notch_filter_frequency'] = 0
     if notch_filter_mode == 1:
         header['notch_filter_frequency'] = 50
@@ -113,28 +442,27 @@ def read_rhd(fid):
         header['notch_filter_frequency'] = 60
     freq['notch_filter_frequency'] = header['notch_filter_frequency']
 
-    (freq['desired_impedance_test_frequency'], freq['actual_impedance_test_frequency']) = struct.unpack('<ff',
-                                                                                                        fid.read(8))
+    (freq['desired_impedance_test_frequency'], freq['actual_impedance_test_frequency']) = reader.unpack('<ff')
 
-    note1 = _read_qstring(fid)
-    note2 = _read_qstring(fid)
-    note3 = _read_qstring(fid)
+    note1 = reader.qstring()
+    note2 = reader.qstring()
+    note3 = reader.qstring()
     header['notes'] = {'note1': note1, 'note2': note2, 'note3': note3}
 
     # If data file is from GUI v1.1 or later, see if temperature sensor data was saved.
     header['num_temp_sensor_channels'] = 0
     if (version['major'] == 1 and version['minor'] >= 1) or (version['major'] > 1):
-        header['num_temp_sensor_channels'], = struct.unpack('<h', fid.read(2))
+        header['num_temp_sensor_channels'], = reader.unpack('<h')
 
     # If data file is from GUI v1.3 or later, load eval board mode.
     header['eval_board_mode'] = 0
     if ((version['major'] == 1) and (version['minor'] >= 3)) or (version['major'] > 1):
-        header['eval_board_mode'], = struct.unpack('<h', fid.read(2))
+        header['eval_board_mode'], = reader.unpack('<h')
 
     header['num_samples_per_data_block'] = 60
     # If data file is from v2.0 or later (Intan Recording Controller), load name of digital reference channel
     if version['major'] > 1:
-        header['reference_channel'] = _read_qstring(fid)
+        header['reference_channel'] = reader.qstring()
         header['num_samples_per_data_block'] = 128
 
     # Place frequency-related information in data structure. (Note: much of this structure is set above)
@@ -154,47 +482,37 @@ def read_rhd(fid):
     header['board_adc_channels'] = []
     header['board_dig_in_channels'] = []
     header['board_dig_out_channels'] = []
+    channel_lists = [header['amplifier_channels'], header['aux_input_channels'], header['supply_voltage_channels'],
+                     header['board_adc_channels'], header['board_dig_in_channels'], header['board_dig_out_channels']]
 
     # Read signal summary from data file header.
-    number_of_signal_groups, = struct.unpack('<h', fid.read(2))
+    number_of_signal_groups, = reader.unpack('<h')
 
     for signal_group in range(1, number_of_signal_groups + 1):
-        signal_group_name = _read_qstring(fid)
-        signal_group_prefix = _read_qstring(fid)
-        (signal_group_enabled, signal_group_num_channels, signal_group_num_amp_channels) = struct.unpack('<hhh',
-                                                                                                         fid.read(6))
+        signal_group_name = reader.qstring()
+        signal_group_prefix = reader.qstring()
+        (signal_group_enabled, signal_group_num_channels, signal_group_num_amp_channels) = reader.unpack('<hhh')
 
         if (signal_group_num_channels > 0) and (signal_group_enabled > 0):
             for signal_channel in range(0, signal_group_num_channels):
                 new_channel = {'port_name': signal_group_name, 'port_prefix': signal_group_prefix,
                                'port_number': signal_group}
-                new_channel['native_channel_name'] = _read_qstring(fid)
-                new_channel['custom_channel_name'] = _read_qstring(fid)
-                (new_channel['native_order'], new_channel['custom_order'], signal_type, channel_enabled,
-                 new_channel['chip_channel'], new_channel['board_stream']) = struct.unpack('<hhhhhh', fid.read(12))
-                new_trigger_channel = {}
-                (new_trigger_channel['voltage_trigger_mode'], new_trigger_channel['voltage_threshold'],
-                 new_trigger_channel['digital_trigger_channel'],
-                 new_trigger_channel['digital_edge_polarity']) = struct.unpack('<hhhh', fid.read(8))
-                (new_channel['electrode_impedance_magnitude'],
-                 new_channel['electrode_impedance_phase']) = struct.unpack('<ff', fid.read(8))
-
-                if channel_enabled:
-                    if signal_type == 0:
-                        header['amplifier_channels'].append(new_channel)
-                        header['spike_triggers'].append(new_trigger_channel)
-                    elif signal_type == 1:
-                        header['aux_input_channels'].append(new_channel)
-                    elif signal_type == 2:
-                        header['supply_voltage_channels'].append(new_channel)
-                    elif signal_type == 3:
-                        header['board_adc_channels'].append(new_channel)
-                    elif signal_type == 4:
-                        header['board_dig_in_channels'].append(new_channel)
-                    elif signal_type == 5:
-                        header['board_dig_out_channels'].append(new_channel)
-                    else:
+                new_channel['native_channel_name'] = reader.qstring()
+                new_channel['custom_channel_name'] = reader.qstring()
+                record = dict(zip(_RHD_CHANNEL_DTYPE.names, reader.record(_RHD_CHANNEL_DTYPE).tolist()))
+                for key in ['native_order', 'custom_order', 'chip_channel', 'board_stream',
+                            'electrode_impedance_magnitude', 'electrode_impedance_phase']:
+                    new_channel[key] = record[key]
+                new_trigger_channel = {key: record[key] for key in ['voltage_trigger_mode', 'voltage_threshold',
+                                                                    'digital_trigger_channel',
+                                                                    'digital_edge_polarity']}
+
+                if record['channel_enabled']:
+                    if not 0 <= record['signal_type'] < len(channel_lists):
                         raise Exception('Unknown channel type.')
+                    channel_lists[record['signal_type']].append(new_channel)
+                    if record['signal_type'] == 0:
+                        header['spike_triggers'].append(new_trigger_channel)
 
     # Summarize contents of data file.
     header['num_amplifier_channels'] = len(header['amplifier_channels'])
@@ -203,12 +521,198 @@ def read_rhd(fid):
     header['num_board_adc_channels'] = len(header['board_adc_channels'])
     header['num_board_dig_in_channels'] = len(header['board_dig_in_channels'])
     header['num_board_dig_out_channels'] = len(header['board_dig_out_channels'])
+    header['header_size'] = reader.pos
 
     return header
 
 
+def digital_edges(v, edge='rising', bit=None, block_size=2 ** 20):
+    """Sample indexes at which digital input `v` goes up ('rising'), down ('falling') or either way ('both').
+
+    `v` is a (memory-mapped) digital input, e.g. as returned by `memmap_channel`; with `bit`, that bit of each
+    (uint16) sample is used, so any line of a word holding several digital inputs can be picked. The input is
+    read `block_size` samples at a time, carrying the last sample of a block over to the next, so memory use
+    does not grow with the length of the recording. An edge is reported at the first sample of the new level.
+    """
+    compare = {'rising': less, 'falling': greater, 'both': not_equal}[edge]
+    edges, previous = [], None
+    for offset in range(0, len(v), block_size):
+        x = asarray(v[offset:offset + block_size])
+        if bit is not None:
+            x = (x >> bit) & 1
+        if previous is not None and compare(previous, x[0]):
+            edges.append([offset])
+        edges.append(nonzero(compare(x[:-1], x[1:]))[0] + offset + 1)
+        previous = x[-1]
+    return concatenate(edges).astype(int64) if edges else empty(0, dtype=int64)
+
+
+def correct_presentations(image_order, fixation_correct, items):
+    """Group the correctly fixated presentations in `image_order` by item, in one stable sort.
+
+    Returns (index, starts, counts): the presentations (indexes into `image_order`) of items[i] are
+    index[starts[i]:starts[i] + counts[i]], in the order they were shown.
+    """
+    correct, = nonzero(asarray(fixation_correct) == 1)
+    order = argsort(asarray(image_order)[correct], kind='stable')
+    shown = asarray(image_order)[correct][order]
+    starts = searchsorted(shown, items, side='left')
+    return correct[order], starts, searchsorted(shown, items, side='right') - starts
+
+
+def trial_table(image_order, fixation_correct, items, n_trials):
+    """Dense (item, trial) array of the presentations (indexes into `image_order`) of the first `n_trials`
+    correctly fixated trials of each of `items`.
+    """
+    index, starts, counts = correct_presentations(image_order, fixation_correct, items)
+    assert (counts >= n_trials).all(), 'Items with fewer than %d correct trials: %s' % (
+        n_trials, asarray(items)[counts < n_trials].tolist())
+    return index[starts[:, None] + arange(n_trials)]
+
+
+def trial_onsets(trial_times, items, n_trials):
+    """Gather the `trial_times` of a parameters file into a dense (item, trial) array of onsets (in sec)."""
+    onsets = empty((len(items), n_trials))
+    for i, item in enumerate(items):
+        for trial in range(n_trials):
+            onsets[i, trial] = trial_times[str(item)][str(trial + 1)]
+    return onsets
+
+
+def window_spikes(spike_times, onsets, start_time, stop_time):
+    """Cut sorted spike times into windows around each of the given onsets.
+
+    Spike times in [onset - start_time, onset + stop_time] are kept and aligned to
+    their onset. `onsets` can have any shape (e.g. (item, trial)); windows are laid
+    out in the same (C) order. Returns (times, offsets) in CSR style: the spikes of
+    the i-th window (in flattened order) are times[offsets[i]:offsets[i + 1]].
+    """
+    spike_times = asarray(spike_times, dtype=float)
+    onsets = asarray(onsets, dtype=float).ravel()
+
+    # Spikes that fall in each window form a contiguous run of the sorted spike times.
+    lo = searchsorted(spike_times, onsets - start_time, side='left')
+    hi = searchsorted(spike_times, onsets + stop_time, side='right')
+    counts = (hi - lo).clip(min=0)
+    offsets = concatenate(([0], cumsum(counts)))
+
+    # Index of every kept spike, and the onset it is aligned to, in one pass.
+    idxs = arange(offsets[-1]) - repeat(offsets[:-1] - lo, counts)
+    return spike_times[idxs] - repeat(onsets, counts), offsets
+
+
+def cumulative_spike_counts(times, offsets, edges):
+    """Count the spikes of each CSR cell (see `window_spikes`) below, and up to, each of the increasing `edges`.
+
+    Returns two (n_cells, n_edges) arrays: the number of spikes < edges[k], and <= edges[k]. The number of
+    spikes in any window [edges[i], edges[j]] is then a subtraction: le[:, j] - lt[:, i]. All spikes are
+    counted in one pass.
+    """
+    times = asarray(times, dtype=float)
+    n_cells, n_edges = len(offsets) - 1, len(edges)
+    cells = repeat(arange(n_cells), diff(offsets)) * (n_edges + 1)
+
+    # A spike counts towards all edges from the first one above (or at) it on.
+    counts = []
+    for side in ['right', 'left']:
+        first = bincount(cells + searchsorted(edges, times, side=side), minlength=n_cells * (n_edges + 1))
+        counts.append(cumsum(first.reshape(n_cells, n_edges + 1), axis=1)[:, :n_edges])
+    return counts[0], counts[1]
+
+
+@contextmanager
+def atomic_open(file, mode='wb'):
+    """Open a temporary file for writing, which replaces `file` once it is complete.
+
+    Readers, and concurrent runs, never see a partially written file.
+    """
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(temp_file, file)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+
+
+def share_arrays(arrays):
+    """Copy the named `arrays` into shared memory, so worker processes can attach to them instead of getting
+    pickled copies with every task.
+
+    Returns the shared memory blocks, to be closed and unlinked once the workers are done, and a (picklable)
+    description of the arrays to pass on to `attach_arrays`. Arrays are stored as float64.
+    """
+    shms, shared = [], {}
+    for name, value in arrays.items():
+        value = asarray(value, dtype='float64')
+        shm = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+        ndarray(value.shape, dtype='float64', buffer=shm.buf)[...] = value
+        shms.append(shm)
+        shared[name] = (shm.name, value.shape)
+    return shms, shared
+
+
+@contextmanager
+def attach_arrays(shared, names=None):
+    """Attach to arrays shared by `share_arrays` (those in `names`, or all of them) from a worker process.
+
+    Yields a dict of the arrays. Views into the shared memory have to be released before the context ends, as
+    the memory cannot be closed while they exist.
+    """
+    names = list(shared) if names is None else list(names)
+    shms = [shared_memory.SharedMemory(name=shared[_][0]) for _ in names]
+    arrays = {name: ndarray(shared[name][1], dtype='float64', buffer=shm.buf) for name, shm in zip(names, shms)}
+    try:
+        yield arrays
+    finally:
+        arrays.clear()
+        for shm in shms:
+            try:
+                shm.close()
+            except BufferError:
+                # Views still held by the traceback of an error; they are released along with the worker.
+                pass
+
+
 def read_json(file):
     assert os.path.isfile(file)
     assert file.lower().endswith('.json')
     with open(file) as f:
         return json.load(f)
+
+
+def store_metadata(directory, metadata):
+    """Store the `metadata` blob in `directory`, named after the sha1 of its JSON text; returns that hash.
+
+    A blob that is already in the store is not written again, so sessions with the same metadata share one file.
+    """
+    text = json.dumps(metadata, indent=4)
+    key = hashlib.sha1(text.encode()).hexdigest()
+    file = os.path.join(directory, key + '.json')
+    if not os.path.isfile(file):
+        os.makedirs(directory, exist_ok=True)
+        with atomic_open(file, 'w') as f:
+            f.write(text)
+    return key
+
+
+def load_metadata(directory, key):
+    """Load the metadata blob stored under `key` in `directory` (see store_metadata).
+
+    Blobs are only read once per process; the returned object is shared, and should not be modified.
+    """
+    if key not in _metadata:
+        _metadata[key] = read_json(os.path.join(directory, key + '.json'))
+    return _metadata[key]
+
+
+def resolve_metadata(parameters, directory):
+    """Replace the metadata hashes in `parameters` by the metadata blobs (in `directory`) they refer to, in place.
+
+    Parameters that hold the metadata itself (as written before the store existed) are left as they are.
+    """
+    for key in METADATA_KEYS:
+        if isinstance(parameters.get(key), str):
+            parameters[key] = load_metadata(directory, parameters[key])
+    return parameters